@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+连接数基准测试 - 大量空闲长连接下运行中服务器的 ping 延迟
+
+先对运行中的 FreeCAD MCP 服务器打开 N 个空闲连接（定期发送 ping 保持活跃，
+避免触发空闲超时），再在一条新连接上测量 ping 往返延迟:
+    python benchmarks/bench_connections.py --counts 5,50,500,2000 --socket /tmp/freecad_mcp.sock
+
+服务器端的连接上限由 FREECAD_MCP_MAX_CLIENTS 设置（默认 1024），
+超出上限的连接进入等待队列，不会得到响应。
+"""
+
+import argparse
+import json
+import os
+import socket
+import statistics
+import time
+
+
+def _raise_fd_limit(needed):
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < needed:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (min(needed, hard), hard))
+        except (ValueError, OSError):
+            pass
+
+
+def _connect(target, timeout):
+    if target[0] == "unix":
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    sock.connect(target[1])
+    return sock
+
+
+def _ping(sock):
+    sock.sendall(json.dumps({"type": "ping"}).encode('utf-8'))
+    data = b''
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            raise ConnectionError("服务器关闭了连接")
+        data += chunk
+        try:
+            return json.loads(data.decode('utf-8'))
+        except json.JSONDecodeError:
+            continue
+
+
+def measure(target, idle, samples, timeout):
+    """返回 (延迟列表(ms), 收到响应的空闲连接数)"""
+    # 每条空闲连接都 ping 一次，确认已被服务器接纳而不是仍在等待队列中
+    served = 0
+    for sock in idle:
+        try:
+            _ping(sock)
+            served += 1
+        except (OSError, ConnectionError):
+            pass
+    latencies = []
+    probe = _connect(target, timeout)
+    try:
+        for _ in range(samples):
+            start = time.perf_counter()
+            _ping(probe)
+            latencies.append((time.perf_counter() - start) * 1000)
+    finally:
+        probe.close()
+    return latencies, served
+
+
+def main():
+    parser = argparse.ArgumentParser(description='FreeCAD MCP 连接数基准')
+    parser.add_argument('--host', default='localhost', help='FreeCAD服务器主机')
+    parser.add_argument('--port', type=int, default=9876, help='FreeCAD服务器端口')
+    parser.add_argument('--socket', default=None, help='FreeCAD服务器Unix域套接字路径')
+    parser.add_argument('--counts', default='5,50,500', help='空闲连接数列表')
+    parser.add_argument('--samples', type=int, default=200, help='每组 ping 次数')
+    parser.add_argument('--timeout', type=float, default=10, help='单个请求的超时秒数')
+    args = parser.parse_args()
+
+    target = ("unix", args.socket) if args.socket else ("tcp", (args.host, args.port))
+    counts = [int(n) for n in args.counts.split(',')]
+    _raise_fd_limit(max(counts) + 64)
+    print(f"{'空闲连接':>8} {'已接纳':>8} {'p50(ms)':>10} {'p99(ms)':>10} {'max(ms)':>10}")
+    idle = []
+    for n in counts:
+        try:
+            while len(idle) < n:
+                idle.append(_connect(target, args.timeout))
+        except OSError as e:
+            print(f"{n:>8} 无法建立连接: {e}")
+            break
+        try:
+            latencies, served = measure(target, idle, args.samples, args.timeout)
+        except (OSError, ConnectionError) as e:
+            print(f"{n:>8} 测量失败: {e}")
+            break
+        latencies.sort()
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        print(f"{n:>8} {served:>8} {statistics.median(latencies):>10.3f} {p99:>10.3f} {latencies[-1]:>10.3f}")
+    for sock in idle:
+        sock.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+空间查询基准测试 - 逐个遍历包围盒与 SpatialIndex 的查询耗时
+
+随机生成若干包围盒，对比线性扫描和 R 树的区域查询、最近邻查询，
+并统计少量对象变化后的增量更新开销:
+    python benchmarks/bench_spatial.py --counts 1000,10000,50000
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from freecad_mcp_spatial import SpatialIndex, boxes_intersect, expand_box, point_box_distance
+
+WORLD = 10000.0
+
+
+def random_box(rng):
+    x, y, z = (rng.uniform(0, WORLD) for _ in range(3))
+    size = rng.uniform(1, 50)
+    return (x, y, z, x + size, y + size, z + size)
+
+
+def _per_query_us(fn, queries):
+    start = time.perf_counter()
+    for q in queries:
+        fn(q)
+    return (time.perf_counter() - start) / len(queries) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description='FreeCAD MCP 空间索引基准')
+    parser.add_argument('--counts', default='1000,10000,50000', help='对象数量列表')
+    parser.add_argument('--queries', type=int, default=200, help='每组查询次数')
+    parser.add_argument('--updates', type=int, default=100, help='每组增量更新的对象数')
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    print(f"{'对象数':>8} {'构建(ms)':>10} {'区域-扫描(us)':>14} {'区域-索引(us)':>14}"
+          f" {'最近-扫描(us)':>14} {'最近-索引(us)':>14} {'更新(us/个)':>12}")
+    for n in [int(c) for c in args.counts.split(',')]:
+        boxes = {f"Obj{i}": random_box(rng) for i in range(n)}
+        regions = [expand_box(random_box(rng), 200) for _ in range(args.queries)]
+        points = [random_box(rng)[:3] for _ in range(args.queries)]
+
+        start = time.perf_counter()
+        index = SpatialIndex()
+        index.bulk_load(boxes.items())
+        build_ms = (time.perf_counter() - start) * 1000
+
+        scan_region = _per_query_us(lambda r: [k for k, b in boxes.items() if boxes_intersect(b, r)], regions)
+        index_region = _per_query_us(index.query, regions)
+        scan_nearest = _per_query_us(
+            lambda p: sorted((point_box_distance(p, b), k) for k, b in boxes.items())[:5], points)
+        index_nearest = _per_query_us(lambda p: index.nearest(p, 5), points)
+
+        names = rng.sample(list(boxes), min(args.updates, n))
+        start = time.perf_counter()
+        for name in names:
+            index.insert(name, random_box(rng))
+        update_us = (time.perf_counter() - start) / len(names) * 1e6
+
+        print(f"{n:>8} {build_ms:>10.1f} {scan_region:>14.1f} {index_region:>14.1f}"
+              f" {scan_nearest:>14.1f} {index_nearest:>14.1f} {update_us:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
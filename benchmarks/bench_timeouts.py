@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+连接簿记基准测试 - 每个轮询周期的开销与空闲连接数的关系
+
+对比旧实现（遍历 client_timeouts 字典 + select.select + list.remove）
+与当前实现（TimerWheel + selectors + set），连接数从 5 增加到 5000:
+    python benchmarks/bench_timeouts.py
+"""
+
+import argparse
+import os
+import select
+import selectors
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from freecad_mcp_scheduler import TimerWheel
+
+CONNECTION_TIMEOUT = 30
+# select.select 只能处理编号小于 FD_SETSIZE 的描述符
+FD_SETSIZE = 1024
+
+
+def _raise_fd_limit(needed):
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < needed:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (min(needed, hard), hard))
+        except (ValueError, OSError):
+            pass
+
+
+def bench_legacy(conns, ticks):
+    clients = list(conns)
+    client_timeouts = {c: time.time() for c in clients}
+    use_select = max(c.fileno() for c in clients) < FD_SETSIZE
+    start = time.perf_counter()
+    for i in range(ticks):
+        if use_select:
+            select.select(clients, [], [], 0)
+        now = time.time()
+        expired = [c for c, last in client_timeouts.items() if now - last > CONNECTION_TIMEOUT]
+        for c in expired:
+            clients.remove(c)
+        # 模拟一个连接断开后重连
+        c = clients[i % len(clients)]
+        clients.remove(c)
+        clients.append(c)
+        client_timeouts[c] = now
+    return (time.perf_counter() - start) / ticks * 1e6, use_select
+
+
+def bench_wheel(conns, ticks):
+    selector = selectors.DefaultSelector()
+    clients = set()
+    wheel = TimerWheel(tick=0.5, now=time.time())
+    for c in conns:
+        selector.register(c, selectors.EVENT_READ)
+        clients.add(c)
+        wheel.schedule(c, time.time() + CONNECTION_TIMEOUT)
+    order = list(conns)
+    start = time.perf_counter()
+    for i in range(ticks):
+        selector.select(0)
+        now = time.time()
+        for c in wheel.advance(now):
+            clients.discard(c)
+        c = order[i % len(order)]
+        clients.discard(c)
+        clients.add(c)
+        wheel.touch(c, now + CONNECTION_TIMEOUT)
+    elapsed = (time.perf_counter() - start) / ticks * 1e6
+    selector.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='FreeCAD MCP 连接簿记基准')
+    parser.add_argument('--ticks', type=int, default=2000, help='每组模拟的轮询周期数')
+    parser.add_argument('--counts', default='5,50,500,5000', help='空闲连接数列表')
+    args = parser.parse_args()
+
+    counts = [int(n) for n in args.counts.split(',')]
+    _raise_fd_limit(max(counts) * 2 + 64)
+    print(f"{'连接数':>8} {'旧实现(us/周期)':>16} {'时间轮(us/周期)':>16}")
+    for n in counts:
+        pairs = []
+        try:
+            for _ in range(n):
+                pairs.append(socket.socketpair())
+        except OSError as e:
+            print(f"{n:>8} 无法创建足够的套接字: {e}")
+            break
+        conns = [a for a, _ in pairs]
+        legacy, used_select = bench_legacy(conns, args.ticks)
+        wheel = bench_wheel(conns, args.ticks)
+        note = "" if used_select else "  (描述符超出 FD_SETSIZE，旧实现未计入 select)"
+        print(f"{n:>8} {legacy:>16.1f} {wheel:>16.1f}{note}")
+        for a, b in pairs:
+            a.close()
+            b.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+传输层延迟基准测试 - TCP 回环 vs Unix 域套接字
+
+对运行中的 FreeCAD MCP 服务器发送 ping 命令并统计往返延迟:
+    python benchmarks/bench_transport.py --socket /tmp/freecad_mcp.sock
+
+未启动 FreeCAD 时可使用 --standalone，在本进程内启动一个
+使用相同 JSON 协议的回显服务器，仅测量传输层开销。
+"""
+
+import argparse
+import json
+import os
+import socket
+import statistics
+import tempfile
+import threading
+import time
+
+
+def _recv_json(sock):
+    """读取直到收到一个完整的 JSON 响应"""
+    data = b''
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            raise ConnectionError("服务器关闭了连接")
+        data += chunk
+        try:
+            return json.loads(data.decode('utf-8'))
+        except json.JSONDecodeError:
+            continue
+
+
+def _connect(target):
+    if target[0] == "unix":
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(target[1])
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.connect(target[1])
+    return sock
+
+
+def bench(target, iterations, payload_size, reuse):
+    """返回每次往返的延迟列表(微秒)"""
+    command = json.dumps({"type": "ping", "params": {"payload": "x" * payload_size}}).encode('utf-8')
+    samples = []
+    sock = _connect(target) if reuse else None
+    for _ in range(iterations):
+        start = time.perf_counter()
+        if not reuse:
+            sock = _connect(target)
+        sock.sendall(command)
+        _recv_json(sock)
+        if not reuse:
+            sock.close()
+        samples.append((time.perf_counter() - start) * 1e6)
+    if reuse:
+        sock.close()
+    return samples
+
+
+def _serve_echo(listener):
+    """独立模式下的回显服务器，每个连接一个线程"""
+    def handle(conn):
+        data = b''
+        with conn:
+            while True:
+                chunk = conn.recv(65536)
+                if not chunk:
+                    return
+                data += chunk
+                try:
+                    json.loads(data.decode('utf-8'))
+                except json.JSONDecodeError:
+                    continue
+                data = b''
+                conn.sendall(json.dumps({"result": "success", "message": "pong"}).encode('utf-8'))
+
+    while True:
+        try:
+            conn, _ = listener.accept()
+        except OSError:
+            return
+        threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+
+def _start_standalone():
+    tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    tcp.bind(("127.0.0.1", 0))
+    tcp.listen(64)
+    sock_path = os.path.join(tempfile.mkdtemp(), "bench.sock")
+    unix = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    unix.bind(sock_path)
+    unix.listen(64)
+    for listener in (tcp, unix):
+        threading.Thread(target=_serve_echo, args=(listener,), daemon=True).start()
+    return tcp.getsockname(), sock_path
+
+
+def _report(name, samples):
+    samples = sorted(samples)
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    print(f"{name:<10} mean={statistics.mean(samples):8.1f}us  "
+          f"p50={statistics.median(samples):8.1f}us  p99={p99:8.1f}us")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='FreeCAD MCP 传输层延迟基准')
+    parser.add_argument('--host', default='localhost', help='FreeCAD服务器主机')
+    parser.add_argument('--port', type=int, default=9876, help='FreeCAD服务器端口')
+    parser.add_argument('--socket', default=None, help='FreeCAD服务器Unix域套接字路径')
+    parser.add_argument('--iterations', type=int, default=1000, help='每种传输的请求次数')
+    parser.add_argument('--payload', type=int, default=64, help='请求负载字节数')
+    parser.add_argument('--reuse', action='store_true', help='复用连接（默认每次请求新建连接，与客户端行为一致）')
+    parser.add_argument('--standalone', action='store_true', help='使用进程内回显服务器，不需要 FreeCAD')
+    args = parser.parse_args()
+
+    if args.standalone:
+        tcp_addr, sock_path = _start_standalone()
+    else:
+        tcp_addr, sock_path = (args.host, args.port), args.socket
+
+    targets = [("tcp", tcp_addr)]
+    if sock_path:
+        targets.append(("unix", sock_path))
+    mode = "复用连接" if args.reuse else "每次新建连接"
+    print(f"{args.iterations} 次往返, 负载 {args.payload} 字节, {mode}")
+    for target in targets:
+        bench(target, min(50, args.iterations), args.payload, args.reuse)  # 预热
+        _report(target[0], bench(target, args.iterations, args.payload, args.reuse))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+FreeCAD MCP 宏补丁
+
+纯 Python 模块（不依赖 FreeCAD）。patch_macro 用这里的函数把按行号区间的编辑
+或单文件 unified diff 应用到服务器上的宏源码，出错时抛出 ValueError，不修改文件。
+"""
+
+import re
+
+
+_HUNK_RE = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+
+
+def apply_line_edits(lines, edits):
+    """
+    按行号区间替换文本
+
+    每个编辑为 {"start": 起始行, "end": 结束行, "text": 替换文本}，行号从 1 开始且包含 end；
+    end = start - 1 表示在 start 行之前插入。所有行号都相对于原始版本。
+    """
+    ordered = sorted(edits, key=lambda e: int(e["start"]))
+    result = []
+    pos = 0
+    for edit in ordered:
+        start, end = int(edit["start"]) - 1, int(edit["end"])
+        if start < pos or end < start or end > len(lines):
+            raise ValueError(f"编辑区间无效或重叠: {edit['start']}-{edit['end']}")
+        result.extend(lines[pos:start])
+        result.extend(edit.get("text", "").splitlines())
+        pos = end
+    result.extend(lines[pos:])
+    return result
+
+
+def apply_unified_diff(lines, diff):
+    """将单文件 unified diff 应用到原始行列表，上下文不匹配时抛出 ValueError"""
+    result = []
+    pos = 0
+    diff_lines = diff.splitlines()
+    i = 0
+    while i < len(diff_lines):
+        match = _HUNK_RE.match(diff_lines[i])
+        i += 1
+        if not match:
+            # 跳过 ---/+++ 文件头
+            continue
+        old_start, old_count = int(match.group(1)), int(match.group(2) or 1)
+        # 旧版本行数为 0 时，old_start 指向插入位置之前的行
+        hunk_start = old_start if old_count == 0 else old_start - 1
+        if hunk_start < pos:
+            raise ValueError("补丁块重叠或顺序错误")
+        result.extend(lines[pos:hunk_start])
+        pos = hunk_start
+        while i < len(diff_lines) and not diff_lines[i].startswith('@@'):
+            line = diff_lines[i]
+            i += 1
+            tag, body = line[:1], line[1:]
+            if tag == '\\':
+                continue  # "\ No newline at end of file"
+            if tag == '+':
+                result.append(body)
+            elif tag in (' ', '-', ''):
+                if pos >= len(lines) or lines[pos] != body:
+                    raise ValueError(f"补丁上下文不匹配: 第 {pos + 1} 行")
+                if tag != '-':
+                    result.append(body)
+                pos += 1
+            else:
+                raise ValueError(f"无法解析的补丁行: {line}")
+    result.extend(lines[pos:])
+    return result
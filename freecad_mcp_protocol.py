@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+FreeCAD MCP 传输协议
+
+服务器与客户端共用的纯 Python 模块（不依赖 FreeCAD）。
+
+默认使用 JSON 文本协议：每条消息为一个 UTF-8 JSON 对象。客户端可在连接建立后
+发送 hello 握手协商二进制帧格式，之后该连接上的所有消息都使用帧传输。
+客户端可以缓存协商结果，之后的新连接直接发送帧；服务器根据魔数识别帧，
+以请求帧的编码回复，无需每个连接重新握手:
+
+    帧头   !2sBBHI  魔数 b"FM", 标志位, 编码, 附件数量 n, 负载长度
+    长度表 (n + 1) 个 !I  消息体长度, 各附件长度（均为未压缩长度）
+    负载   消息体 + 附件原始字节，设置 FLAG_COMPRESSED 时整体经过 zlib 压缩
+
+消息中任意位置的 bytes 值都会作为原始附件传输，在消息体中以
+{"__attachment__": 序号} 占位；JSON 文本协议下则退化为 {"__base64__": "..."}。
+"""
+
+import base64
+import hashlib
+import json
+import struct
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+PROTOCOL_VERSION = 1
+
+MAGIC = b"FM"
+HEADER = struct.Struct("!2sBBHI")
+LENGTH = struct.Struct("!I")
+
+FLAG_COMPRESSED = 0x01
+
+ENCODING_JSON = 0
+ENCODING_MSGPACK = 1
+ENCODING_IDS = {"json": ENCODING_JSON, "msgpack": ENCODING_MSGPACK}
+ENCODING_NAMES = {v: k for k, v in ENCODING_IDS.items()}
+
+ATTACHMENT_KEY = "__attachment__"
+BASE64_KEY = "__base64__"
+
+DEFAULT_COMPRESS_THRESHOLD = 4096  # 小于该大小的负载不压缩
+MAX_MESSAGE_SIZE = 256 * 1024 * 1024  # 长度表声明的解压后总长度上限
+
+
+class ProtocolError(Exception):
+    """帧格式错误或协商失败"""
+
+
+def supported_encodings():
+    """本端支持的编码，按优先级排序"""
+    return ["msgpack", "json"] if msgpack else ["json"]
+
+
+def supported_compression():
+    return ["zlib"]
+
+
+def negotiate(offered, supported):
+    """从对端按优先级给出的列表中选出本端也支持的第一项"""
+    for name in offered or []:
+        if name in supported:
+            return name
+    return None
+
+
+def content_hash(text):
+    """宏源码的内容哈希，服务器与客户端必须使用同一算法"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def _extract_attachments(value, attachments):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        attachments.append(bytes(value))
+        return {ATTACHMENT_KEY: len(attachments) - 1}
+    if isinstance(value, dict):
+        return {k: _extract_attachments(v, attachments) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_extract_attachments(v, attachments) for v in value]
+    return value
+
+
+def _restore_attachments(value, attachments):
+    if isinstance(value, dict):
+        if len(value) == 1 and ATTACHMENT_KEY in value:
+            index = value[ATTACHMENT_KEY]
+            if not isinstance(index, int) or isinstance(index, bool) or not 0 <= index < len(attachments):
+                raise ProtocolError(f"无效的附件序号: {index!r}")
+            return attachments[index]
+        if len(value) == 1 and BASE64_KEY in value:
+            return base64.b64decode(value[BASE64_KEY])
+        return {k: _restore_attachments(v, attachments) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_restore_attachments(v, attachments) for v in value]
+    return value
+
+
+def to_json_compatible(value):
+    """JSON 文本协议下将 bytes 转为 base64 占位对象"""
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return {BASE64_KEY: base64.b64encode(bytes(value)).decode('ascii')}
+    if isinstance(value, dict):
+        return {k: to_json_compatible(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_json_compatible(v) for v in value]
+    return value
+
+
+def from_json_compatible(value):
+    """还原 JSON 文本协议中的 base64 占位对象"""
+    return _restore_attachments(value, [])
+
+
+def encode_json_text(message):
+    return json.dumps(to_json_compatible(message), ensure_ascii=False).encode('utf-8')
+
+
+def _dumps(message, encoding):
+    if encoding == ENCODING_MSGPACK:
+        return msgpack.packb(message, use_bin_type=True)
+    return json.dumps(message, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def _loads(body, encoding):
+    if encoding == ENCODING_MSGPACK:
+        if msgpack is None:
+            raise ProtocolError("未安装 msgpack，无法解码帧")
+        return msgpack.unpackb(body, raw=False)
+    if encoding == ENCODING_JSON:
+        return json.loads(body.decode('utf-8'))
+    raise ProtocolError(f"未知编码: {encoding}")
+
+
+def encode_frame(message, encoding="json", compress_threshold=None):
+    """
+    将消息编码为二进制帧
+
+    Args:
+        message: 可序列化的消息，bytes 值作为附件传输
+        encoding: 协商得到的编码名称
+        compress_threshold: 负载达到该字节数时使用 zlib 压缩，None 表示不压缩
+    """
+    encoding_id = ENCODING_IDS[encoding]
+    attachments = []
+    body = _dumps(_extract_attachments(message, attachments), encoding_id)
+    lengths = [len(body)] + [len(a) for a in attachments]
+    payload = b"".join([body] + attachments)
+    flags = 0
+    if compress_threshold is not None and len(payload) >= compress_threshold:
+        compressed = zlib.compress(payload, 6)
+        # 不可压缩的数据（如已压缩的附件）保持原样
+        if len(compressed) < len(payload):
+            payload = compressed
+            flags |= FLAG_COMPRESSED
+    header = HEADER.pack(MAGIC, flags, encoding_id, len(attachments), len(payload))
+    table = b"".join(LENGTH.pack(n) for n in lengths)
+    return header + table + payload
+
+
+def parse_header(data):
+    """解析定长帧头，返回 (flags, encoding, 附件数量, 负载长度)"""
+    magic, flags, encoding, count, payload_length = HEADER.unpack(data)
+    if magic != MAGIC:
+        raise ProtocolError("无效的帧魔数")
+    return flags, encoding, count, payload_length
+
+
+def table_size(count):
+    return LENGTH.size * (count + 1)
+
+
+def decode_payload(flags, encoding, table, payload):
+    """根据长度表和负载还原消息"""
+    lengths = [LENGTH.unpack_from(table, i * LENGTH.size)[0] for i in range(len(table) // LENGTH.size)]
+    total = sum(lengths)
+    if total > MAX_MESSAGE_SIZE:
+        raise ProtocolError(f"帧声明的长度 {total} 超过上限 {MAX_MESSAGE_SIZE}")
+    if flags & FLAG_COMPRESSED:
+        # 最多解压到声明长度 + 1 字节，防止小帧膨胀为超大数据
+        try:
+            payload = zlib.decompressobj().decompress(payload, total + 1)
+        except zlib.error as e:
+            raise ProtocolError(f"负载解压失败: {e}")
+    if len(payload) != total:
+        raise ProtocolError("帧长度与负载不一致")
+    view = memoryview(payload)
+    body = bytes(view[:lengths[0]])
+    attachments = []
+    offset = lengths[0]
+    for length in lengths[1:]:
+        attachments.append(bytes(view[offset:offset + length]))
+        offset += length
+    return _restore_attachments(_loads(body, encoding), attachments)
+
+
+def frame_length(buffer):
+    """缓冲区中第一帧的总长度；帧头尚未收全时返回 None"""
+    if len(buffer) < HEADER.size:
+        return None
+    _, _, count, payload_length = parse_header(buffer[:HEADER.size])
+    return HEADER.size + table_size(count) + payload_length
+
+
+def decode_frame(buffer):
+    """
+    从缓冲区头部解码一帧
+
+    Returns:
+        (message, consumed)，数据不完整时返回 (None, 0)
+    """
+    total = frame_length(buffer)
+    if total is None or len(buffer) < total:
+        return None, 0
+    flags, encoding, count, _ = parse_header(buffer[:HEADER.size])
+    table_end = HEADER.size + table_size(count)
+    message = decode_payload(flags, encoding, buffer[HEADER.size:table_end], buffer[table_end:total])
+    return message, total
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+FreeCAD MCP 命令调度器
+
+纯 Python 模块（不依赖 FreeCAD），由服务器在 Qt 主线程中使用。
+每个客户端（按客户端标识，而不是连接）有独立的命令队列，调度器在客户端之间
+轮转取命令，避免单个客户端连续提交 run_macro 时饿死其他客户端；
+TimerWheel 以 O(1) 的开销跟踪大量连接的空闲超时。
+"""
+
+import itertools
+from collections import deque
+
+
+class SchedulerFull(Exception):
+    """客户端未完成的请求数已达上限"""
+
+
+class CommandScheduler:
+    """
+    按客户端分队列的命令调度器
+
+    client 为客户端标识：同一客户端进程通过多条连接发送的命令共用一个队列和在途名额，
+    connection 为收到命令的连接，执行结果发回该连接。
+
+    policy:
+        "round_robin" 在有待执行命令的客户端之间轮转，每次取一条
+        "priority"    优先取队首命令 priority 最高的客户端，同优先级时按轮转顺序
+    """
+
+    POLICIES = ("round_robin", "priority")
+
+    def __init__(self, policy="round_robin", max_inflight_per_client=8):
+        if policy not in self.POLICIES:
+            raise ValueError(f"未知调度策略: {policy}")
+        self.policy = policy
+        self.max_inflight_per_client = max_inflight_per_client
+        self.queues = {}  # client -> deque[(request_id, connection, command, 到达时间)]
+        self.ready = deque()  # 有待执行命令的客户端，轮转顺序
+        self.in_ready = set()  # 已在 ready 中的客户端，保证每个客户端每轮只出现一次
+        self.inflight = {}  # client -> 已接收但尚未完成的请求数
+        self.connection_clients = {}  # connection -> 在该连接上有排队命令的客户端集合
+        self._ids = itertools.count(1)
+
+    def __len__(self):
+        return sum(len(q) for q in self.queues.values())
+
+    def submit(self, client, command, connection=None, received_at=None):
+        """
+        将命令加入客户端队列，返回请求 ID；超过在途上限时抛出 SchedulerFull
+
+        received_at 为服务器收到命令的时间，随命令保存，供轨迹记录排队等待时间。
+        """
+        if self.inflight.get(client, 0) >= self.max_inflight_per_client:
+            raise SchedulerFull(f"未完成请求数已达上限 ({self.max_inflight_per_client})")
+        if connection is None:
+            connection = client
+        request_id = command.get("id")
+        if request_id is None:
+            request_id = f"auto-{next(self._ids)}"
+        queue = self.queues.setdefault(client, deque())
+        # 取消后队列可能已空但客户端仍在 ready 中，不能重复加入
+        if client not in self.in_ready:
+            self.ready.append(client)
+            self.in_ready.add(client)
+        queue.append((request_id, connection, command, received_at))
+        self.connection_clients.setdefault(connection, set()).add(client)
+        self.inflight[client] = self.inflight.get(client, 0) + 1
+        return request_id
+
+    def next(self):
+        """取出下一条待执行命令，返回 (client, connection, request_id, command, received_at)，队列为空时返回 None"""
+        client = self._pick_client()
+        if client is None:
+            return None
+        queue = self.queues[client]
+        request_id, connection, command, received_at = queue.popleft()
+        if queue:
+            self.ready.append(client)
+            self.in_ready.add(client)
+        else:
+            del self.queues[client]
+        return client, connection, request_id, command, received_at
+
+    def _pick_client(self):
+        # 取消或断开连接后队列可能已空，这里惰性跳过
+        while self.ready and not self.queues.get(self.ready[0]):
+            self.in_ready.discard(self.ready.popleft())
+        if not self.ready:
+            return None
+        if self.policy == "priority":
+            best_index, best_priority = 0, None
+            for index, client in enumerate(self.ready):
+                queue = self.queues.get(client)
+                if not queue:
+                    continue
+                priority = queue[0][2].get("priority", 0)
+                if best_priority is None or priority > best_priority:
+                    best_index, best_priority = index, priority
+            self.ready.rotate(-best_index)
+        client = self.ready.popleft()
+        self.in_ready.discard(client)
+        return client
+
+    def complete(self, client):
+        """命令执行完毕（或被取消）后释放在途名额"""
+        count = self.inflight.get(client, 0)
+        if count > 1:
+            self.inflight[client] = count - 1
+        else:
+            self.inflight.pop(client, None)
+
+    def cancel(self, client, request_id):
+        """
+        取消客户端自己队列中尚未执行的命令
+
+        只查找 client 的队列，客户端不能取消其他客户端的请求。
+        返回 (connection, command)，未找到时返回 None。
+        """
+        queue = self.queues.get(client)
+        if not queue:
+            return None
+        for entry in queue:
+            if entry[0] == request_id:
+                queue.remove(entry)
+                self.complete(client)
+                return entry[1], entry[2]
+        return None
+
+    def queued(self, client):
+        """按队列顺序列出客户端尚未执行的请求 (request_id, connection, command, received_at)"""
+        return list(self.queues.get(client, ()))
+
+    def remove_connection(self, connection):
+        """连接断开时丢弃经由该连接提交、尚未执行的命令，结果已无法送达"""
+        for client in self.connection_clients.pop(connection, ()):
+            queue = self.queues.get(client)
+            if not queue:
+                continue
+            kept = deque(entry for entry in queue if entry[1] != connection)
+            for _ in range(len(queue) - len(kept)):
+                self.complete(client)
+            if kept:
+                self.queues[client] = kept
+            else:
+                del self.queues[client]
+
+    def pending(self, client):
+        queue = self.queues.get(client)
+        return len(queue) if queue else 0
+
+
+class TimerWheel:
+    """
+    哈希时间轮，用于跟踪大量连接的超时
+
+    schedule/touch/remove 均为 O(1)。advance 只处理从上次推进以来经过的槽，
+    每个槽内的键要么到期，要么（截止时间被 touch 推后时）重新归档到对应的槽，
+    因此每次推进的开销与到期数量相关，而与跟踪的键总数无关。
+    """
+
+    def __init__(self, tick=0.5, slots=256, now=0.0):
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        self.deadlines = {}  # key -> 截止时间
+        self.slot_of = {}  # key -> 当前所在槽
+        self.current = int(now / tick)  # 已处理到的刻度
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def __contains__(self, key):
+        return key in self.deadlines
+
+    def _file(self, key, deadline):
+        # 已过期的键放入下一刻度的槽，下次推进时即可发现
+        tick_no = max(int(deadline / self.tick), self.current + 1)
+        index = tick_no % len(self.slots)
+        self.slots[index].add(key)
+        self.slot_of[key] = index
+
+    def schedule(self, key, deadline):
+        """设置（或重设）键的截止时间"""
+        self.remove(key)
+        self.deadlines[key] = deadline
+        self._file(key, deadline)
+
+    def touch(self, key, deadline):
+        """
+        推迟键的截止时间
+
+        只更新记录的截止时间（惰性），键所在的槽到期时再重新归档，
+        适合每次收到数据都要刷新的连接活动时间。
+        """
+        if key not in self.deadlines:
+            self.schedule(key, deadline)
+        elif deadline > self.deadlines[key]:
+            self.deadlines[key] = deadline
+        else:
+            self.schedule(key, deadline)
+
+    def remove(self, key):
+        index = self.slot_of.pop(key, None)
+        if index is not None:
+            self.slots[index].discard(key)
+        self.deadlines.pop(key, None)
+
+    def advance(self, now):
+        """推进到 now，返回已到期的键（同时从时间轮中移除）"""
+        target = int(now / self.tick)
+        # 落后超过一圈时每个槽只需处理一次
+        steps = min(target - self.current, len(self.slots))
+        start = self.current
+        # 先推进刻度，未到期的键重新归档到 target 之后的槽
+        self.current = max(self.current, target)
+        expired = []
+        for step in range(1, steps + 1):
+            slot = self.slots[(start + step) % len(self.slots)]
+            if not slot:
+                continue
+            for key in list(slot):
+                deadline = self.deadlines[key]
+                slot.discard(key)
+                if deadline <= now:
+                    del self.deadlines[key]
+                    del self.slot_of[key]
+                    expired.append(key)
+                else:
+                    self._file(key, deadline)
+        return expired
@@ -3,9 +3,22 @@ import FreeCAD as App
 import FreeCADGui as Gui
 import json
 import socket
+import selectors
+import stat
 import traceback
 import time
 import sys
+import tempfile
+import re
+import uuid
+import itertools
+import contextlib
+import cProfile
+import pstats
+import tracemalloc
+import array
+import io
+from collections import OrderedDict, deque
 from PySide2.QtCore import QTimer, QCoreApplication
 from PySide2.QtWidgets import QMessageBox, QTextEdit, QVBoxLayout, QHBoxLayout, QLabel, QPushButton
 from PySide2.QtGui import QIcon
@@ -15,20 +28,29 @@ mod_dir = os.path.join(App.getUserAppDataDir(), "Mod", "freecad_mcp")
 if mod_dir not in sys.path:
     sys.path.append(mod_dir)
 
+import freecad_mcp_protocol as protocol
+from freecad_mcp_patch import apply_line_edits, apply_unified_diff
+from freecad_mcp_scheduler import CommandScheduler, SchedulerFull, TimerWheel
+from freecad_mcp_spatial import SpatialIndex
+from freecad_mcp_trace import TraceRecorder
+
+LOG_FILE = os.path.join(tempfile.gettempdir(), "freecad_mcp_log.txt")
+MAX_LOG_LINES = 100
+
 def log_message(message):
     message = f"[{time.ctime()}] {message}"
     App.Console.PrintMessage(message + "\n")
     if panel_instance and panel_instance.report_browser:
         current_text = panel_instance.report_browser.toPlainText().splitlines()
         current_text.append(message)
-        if len(current_text) > FreeCADMCPServer().max_log_lines:
-            current_text = current_text[-FreeCADMCPServer().max_log_lines:]
+        if len(current_text) > MAX_LOG_LINES:
+            current_text = current_text[-MAX_LOG_LINES:]
         panel_instance.report_browser.setPlainText("\n".join(current_text))
         panel_instance.report_browser.verticalScrollBar().setValue(
             panel_instance.report_browser.verticalScrollBar().maximum()
         )
     try:
-        with open(FreeCADMCPServer().log_file, "a", encoding='utf-8', newline='\n') as f:
+        with open(LOG_FILE, "a", encoding='utf-8', newline='\n') as f:
             f.write(f"{message}\n")
     except Exception as e:
         App.Console.PrintError(f"日志文件写入错误: {str(e)}\n")
@@ -39,36 +61,238 @@ def log_error(message):
     if panel_instance and panel_instance.report_browser:
         current_text = panel_instance.report_browser.toPlainText().splitlines()
         current_text.append(message)  # 修复：统一使用纯文本格式
-        if len(current_text) > FreeCADMCPServer().max_log_lines:
-            current_text = current_text[-FreeCADMCPServer().max_log_lines:]
+        if len(current_text) > MAX_LOG_LINES:
+            current_text = current_text[-MAX_LOG_LINES:]
         panel_instance.report_browser.setPlainText("\n".join(current_text))
         panel_instance.report_browser.verticalScrollBar().setValue(
             panel_instance.report_browser.verticalScrollBar().maximum()
         )
     try:
-        with open(FreeCADMCPServer().log_file, "a", encoding='utf-8', newline='\n') as f:
+        with open(LOG_FILE, "a", encoding='utf-8', newline='\n') as f:
             f.write(f"{message}\n")
     except Exception as e:
         App.Console.PrintError(f"日志文件写入错误: {str(e)}\n")
 
+class JobCancelled(BaseException):
+    """
+    运行中的任务被 cancel_job 取消
+
+    与 KeyboardInterrupt 一样继承 BaseException，宏中的 except Exception 不会吞掉它。
+    """
+
+class StreamClosed(BaseException):
+    """接收流式输出的客户端已断开，终止宏执行；继承 BaseException，原因同 JobCancelled"""
+
+# 中止宏执行的信号，处理宏错误的代码需要与 Exception 一起捕获
+MACRO_ABORTS = (JobCancelled, StreamClosed)
+
+class MacroOutputStream(io.TextIOBase):
+    """
+    宏执行期间替换 sys.stdout/sys.stderr 的有界输出缓冲
+
+    只保留最近 max_chars 个字符；设置 sink 时，累积的输出在遇到换行且距上次发送超过
+    flush_interval 时交给 sink(name, text) 发送给客户端。宏在主线程中执行期间没有定时器，
+    节流中积压的输出在下一次输出、progress() 或执行结束时发送。
+    tee 为原来的流，输出仍会显示在 FreeCAD 控制台。
+    """
+
+    def __init__(self, name, tee=None, sink=None, max_chars=65536, flush_interval=0.1):
+        super().__init__()
+        self.name = name
+        self.tee = tee
+        self.sink = sink
+        self.max_chars = max_chars
+        self.flush_interval = flush_interval
+        self.tail = deque()
+        self.size = 0
+        self.truncated = False
+        self.pending = []
+        self.last_flush = 0.0
+        self.abort_error = None  # 设置后每次写入都抛出，宏无法在输出时继续运行
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        if self.tee is not None:
+            try:
+                self.tee.write(text)
+            except Exception:
+                pass
+        if not text:
+            return 0
+        self.tail.append(text)
+        self.size += len(text)
+        while self.size > self.max_chars and len(self.tail) > 1:
+            self.size -= len(self.tail.popleft())
+            self.truncated = True
+        if self.abort_error is not None:
+            raise self.abort_error("客户端已断开，终止宏执行")
+        if self.sink is not None:
+            self.pending.append(text)
+            if "\n" in text and time.time() - self.last_flush >= self.flush_interval:
+                self.flush()
+        return len(text)
+
+    def flush(self):
+        if self.pending and self.sink is not None:
+            text = "".join(self.pending)
+            self.pending = []
+            self.last_flush = time.time()
+            self.sink(self.name, text)
+
+    def getvalue(self):
+        text = "".join(self.tail)
+        if len(text) > self.max_chars:
+            text = text[-self.max_chars:]
+            self.truncated = True
+        return text
+
+def pack_mesh(points, facets):
+    """
+    将 Shape.tessellate() 的结果打包为小端 float32 顶点数组和 uint32 索引数组
+
+    Returns:
+        (vertices, indices) 两个 bytes，分别为 3 * 顶点数个 float32 和 3 * 三角形数个 uint32
+    """
+    vertices = array.array('f')
+    for point in points:
+        vertices.extend((point.x, point.y, point.z))
+    indices = array.array('I')
+    for facet in facets:
+        indices.extend(facet)
+    if sys.byteorder == 'big':
+        vertices.byteswap()
+        indices.byteswap()
+    return vertices.tobytes(), indices.tobytes()
+
+class DocumentObserver:
+    """FreeCAD 文档观察者，对象变化时递增其修订号，供网格缓存等判断是否失效"""
+
+    def __init__(self, server):
+        self.server = server
+
+    def slotChangedObject(self, obj, prop):
+        try:
+            self.server._bump_revision(obj.Document.Name, obj.Name)
+        except Exception:
+            pass
+
+    def slotDeletedObject(self, obj):
+        try:
+            self.server._forget_object(obj.Document.Name, obj.Name)
+        except Exception:
+            pass
+
+    def slotCreatedDocument(self, doc):
+        try:
+            self.server._document_created(doc.Name)
+        except Exception:
+            pass
+
+    def slotDeletedDocument(self, doc):
+        try:
+            self.server._forget_document(doc.Name)
+        except Exception:
+            pass
+
 class FreeCADMCPServer:
-    def __init__(self, host='localhost', port=9876):
+    def __init__(self, host='localhost', port=9876, socket_path=None, trace_path=None, max_clients=None,
+                 max_documents=None, document_memory_budget=None, save_evicted_documents=None):
         self.host = host
         self.port = port
+        # 可选的 Unix 域套接字路径，同机部署时绕过 TCP 协议栈
+        self.socket_path = socket_path or os.environ.get("FREECAD_MCP_SOCKET")
+        # 可选的命令轨迹文件，用于复现问题和负载测试重放
+        self.trace_path = trace_path or os.environ.get("FREECAD_MCP_TRACE")
+        self.trace_recorder = None
+        self.client_ids = {}  # client -> 连接序号，用于轨迹记录
+        self._client_seq = itertools.count(1)
         self.running = False
         self.socket = None
-        self.clients = []
+        self.unix_socket = None
+        self.clients = set()
+        self.selector = None  # 在 start() 中创建，只返回有数据到达的连接
         self.buffer = {}
         self.timer = None
         # 修复：使用更通用的临时目录路径
-        import tempfile
-        self.log_file = os.path.join(tempfile.gettempdir(), "freecad_mcp_log.txt")
-        self.max_log_lines = 100
-        self.connection_timeout = 30  # 连接超时设置
-        self.max_clients = 5  # 最大客户端连接数
+        self.log_file = LOG_FILE
+        self.max_log_lines = MAX_LOG_LINES
+        # 空闲连接超时，长连接订阅者需定期发送 ping
+        self.connection_timeout = float(os.environ.get("FREECAD_MCP_IDLE_TIMEOUT", 30))
+        # 同时服务的最大客户端连接数；连接簿记为 O(1)，上限主要受文件描述符数量限制
+        self.max_clients = int(max_clients or os.environ.get("FREECAD_MCP_MAX_CLIENTS", 1024))
+        self.max_pending_connections = 256  # 超出 max_clients 后排队等待的连接数
+        self.pending_connections = deque()  # (client, address, 接受时间)
+        self.listen_backlog = 512  # 监听套接字的内核 backlog
         self.buffer_size = 32768  # 缓冲区大小
         self.max_buffer_size = 1024 * 1024  # 最大缓冲区大小(1MB)
-        self.client_timeouts = {}  # 客户端超时跟踪
+        self.client_timeouts = TimerWheel(tick=0.5, now=time.time())  # 客户端空闲超时跟踪
+        self.client_protocols = {}  # 完成 hello 握手的客户端 -> 协商的帧参数
+        self.compress_threshold = protocol.DEFAULT_COMPRESS_THRESHOLD
+        self._processing = False  # 防止 processEvents/updateGui 重入 _process_server
+        # 异步任务
+        self.jobs = OrderedDict()  # job_id -> 任务信息，按提交顺序
+        self.job_queue = deque()  # 等待执行的 job_id
+        self.active_job = None  # 正在执行的任务
+        # wait_job 的延迟响应，等待者为 (client, job_id, 请求 ID, 序号)
+        self.job_waiters = {}  # job_id -> 等待者集合
+        self.client_waiters = {}  # client -> 等待者集合
+        self.waiter_timers = TimerWheel(tick=0.5, now=time.time())
+        self._waiter_ids = itertools.count(1)
+        self.job_commands = {"run_macro", "validate_macro_code"}  # 可作为任务提交的命令
+        # 收到即执行、不进入调度队列的轻量命令，任务执行期间也会响应
+        # submit_job 只把任务加入 job_queue，任务执行期间也能立即返回任务 ID
+        self.immediate_commands = {"hello", "ping", "submit_job", "job_status", "wait_job", "cancel_job",
+                                   "cancel_request", "list_requests", "get_report"}
+        # 命令调度：按客户端标识（client_id）分队列轮转，限制每个客户端的在途请求数
+        self.scheduler = CommandScheduler(policy="round_robin", max_inflight_per_client=8)
+        self.dispatch_budget = 0.05  # 单次调度最多占用的时间(秒)，至少执行一条命令
+        self._dispatching = False
+        self.job_result_ttl = 600  # 已完成任务结果保留时间(秒)
+        self.max_finished_jobs = 100  # 最多保留的已完成任务数
+        self.progress_interval = 0.1  # progress() 处理事件的最小间隔(秒)
+        # 宏性能剖析
+        self.profile_dir = os.path.join(tempfile.gettempdir(), "freecad_mcp_profiles")
+        self.max_profile_files = 50  # 保留的 .pstats 文件数量
+        # 通过 MCP 创建的文档，按最近使用顺序排列（最久未用的在前）
+        self.managed_documents = OrderedDict()  # doc_name -> {"created_at", "last_used", "undo_state"}
+        # 超出后关闭最久未用的文档
+        self.max_documents = int(max_documents or os.environ.get("FREECAD_MCP_MAX_DOCUMENTS", 20))
+        # 形状内存预算(MB)，None 表示不限制
+        memory_budget = document_memory_budget or os.environ.get("FREECAD_MCP_DOCUMENT_MEMORY_MB")
+        self.document_memory_budget = float(memory_budget) if memory_budget else None
+        # 关闭前是否保存；不保存时，有用户修改的文档不会被关闭
+        if save_evicted_documents is None:
+            save_evicted_documents = os.environ.get("FREECAD_MCP_SAVE_EVICTED", "").lower() in ("1", "true", "yes")
+        self.save_evicted_documents = bool(save_evicted_documents)
+        self.run_created_documents = None  # 宏执行期间由宏创建的文档名称，不执行时为 None
+        self._in_progress_events = False  # progress() 正在处理 GUI 事件
+        self.evicted_document_dir = os.path.join(tempfile.gettempdir(), "freecad_mcp_documents")
+        self.checkpoints = {}  # doc_name -> OrderedDict(检查点名称 -> 事务名称)
+        # 预先创建的临时文档池，供验证和试运行租用，用完清空对象而不是销毁
+        self.scratch_pool_size = 2
+        self.scratch_free = deque()  # 空闲的临时文档名称
+        self.scratch_leased = set()  # 已租出的临时文档名称
+        self._scratch_seq = itertools.count(1)
+        # 对象修订号由文档观察者维护，网格缓存按 (文档, 对象, 精度) 保存最近一次细分结果
+        self.document_observer = None
+        self.object_revisions = {}  # (doc_name, obj_name) -> 修订号，未变化过的对象为 0
+        self._revision_seq = itertools.count(1)
+        self.mesh_cache = OrderedDict()  # (doc_name, obj_name, 精度) -> 网格，最久未用的在前
+        self.mesh_cache_bytes = 0
+        self.mesh_cache_budget = 64 * 1024 * 1024  # 网格缓存上限(字节)
+        # lod 级别对应的偏差，相对于对象包围盒对角线长度
+        self.mesh_lod_deviation = {"high": 0.001, "medium": 0.005, "low": 0.02}
+        # 每个文档的包围盒空间索引，首次查询时构建，之后只刷新变化过的对象
+        self.spatial_indexes = {}  # doc_name -> SpatialIndex
+        self.spatial_dirty = {}  # doc_name -> 变化后尚未刷新的对象名称集合
+        self._last_progress_events = 0
+        # 宏输出捕获：run_macro/validate_macro_code 的 stdout/stderr 保留在有界缓冲中随响应返回，
+        # 协商了 stream 的客户端在执行期间实时收到增量帧
+        self.output_max_chars = 65536  # 每个流保留的最大字符数
+        self.stream_flush_interval = 0.1  # 增量帧的最小发送间隔(秒)
+        self.active_capture = None  # 正在执行的命令的输出捕获
 
     def start(self):
         if not App.GuiUp:
@@ -76,21 +300,92 @@ class FreeCADMCPServer:
             log_error("FreeCAD GUI 未初始化，服务器启动失败")
             return
         self.running = True
+        self.selector = selectors.DefaultSelector()
+        self._fit_connection_limits()
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         try:
             self.socket.bind((self.host, self.port))
-            self.socket.listen(5)
+            self.socket.listen(self.listen_backlog)
             self.socket.setblocking(False)
+            if self.socket_path:
+                self._start_unix_listener()
+            if self.trace_path:
+                self.trace_recorder = TraceRecorder(self.trace_path)
+                log_message(f"命令轨迹记录到: {self.trace_path}")
             self.timer = QTimer()
             self.timer.timeout.connect(self._process_server)
             self.timer.start(50)
             log_message(f"FreeCAD MCP 服务器启动于 {self.host}:{self.port}")
+            if self.unix_socket:
+                log_message(f"FreeCAD MCP 服务器监听 Unix 套接字: {self.socket_path}")
+            self._warm_scratch_pool()
+            self.document_observer = DocumentObserver(self)
+            App.addDocumentObserver(self.document_observer)
         except Exception as e:
             QMessageBox.critical(None, "服务器错误", f"服务器启动失败: {str(e)}\n请检查端口 {self.port} 是否被占用。")
             log_error(f"服务器启动失败: {str(e)}")
             self.stop()
 
+    def _fit_connection_limits(self):
+        """按平台调整连接上限：需要时提高文件描述符软限制，select 后端受 FD_SETSIZE 限制"""
+        needed = self.max_clients + self.max_pending_connections + 64
+        try:
+            import resource
+            soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+            if soft != resource.RLIM_INFINITY and soft < needed:
+                new_soft = needed if hard == resource.RLIM_INFINITY else min(needed, hard)
+                resource.setrlimit(resource.RLIMIT_NOFILE, (new_soft, hard))
+                soft = new_soft
+            if soft != resource.RLIM_INFINITY and soft < needed:
+                self.max_clients = max(1, soft - self.max_pending_connections - 64)
+                log_message(f"文件描述符限制为 {soft}，最大连接数调整为 {self.max_clients}")
+        except (ImportError, ValueError, OSError):
+            pass  # Windows 没有 resource 模块
+        if isinstance(self.selector, selectors.SelectSelector):
+            # Windows 上 select() 最多处理 512 个套接字；排队的连接不注册到选择器，不计入
+            if self.max_clients > 500:
+                self.max_clients = 500
+                log_message(f"select 后端限制，最大连接数调整为 {self.max_clients}")
+
+    def _start_unix_listener(self):
+        """启动 Unix 域套接字监听，访问控制由文件权限提供"""
+        if not hasattr(socket, "AF_UNIX"):
+            log_error("当前平台不支持 Unix 域套接字，仅使用 TCP")
+            return
+        # 清理上次异常退出遗留的套接字文件
+        # 只删除套接字文件，路径写错时不能误删普通文件
+        if os.path.lexists(self.socket_path):
+            if not stat.S_ISSOCK(os.lstat(self.socket_path).st_mode):
+                raise FileExistsError(f"{self.socket_path} 已存在且不是套接字文件，请检查 FREECAD_MCP_SOCKET")
+            if self._unix_socket_in_use(self.socket_path):
+                raise FileExistsError(f"{self.socket_path} 上已有其他 FreeCAD MCP 服务器在监听，请使用不同的 FREECAD_MCP_SOCKET")
+            os.unlink(self.socket_path)
+        self.unix_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o177)
+        try:
+            self.unix_socket.bind(self.socket_path)
+        finally:
+            os.umask(old_umask)
+        os.chmod(self.socket_path, 0o600)
+        self.unix_socket.listen(self.listen_backlog)
+        self.unix_socket.setblocking(False)
+
+    def _unix_socket_in_use(self, path):
+        """尝试连接已有的套接字文件：有进程接受连接说明仍在使用，连接被拒绝才是遗留文件"""
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        probe.settimeout(1.0)
+        try:
+            probe.connect(path)
+            return True
+        except (ConnectionRefusedError, FileNotFoundError):
+            return False
+        except OSError:
+            # 超时等情况说明有进程持有该套接字但未及时响应，按占用处理
+            return True
+        finally:
+            probe.close()
+
     def stop(self):
         self.running = False
         if self.timer:
@@ -98,39 +393,68 @@ class FreeCADMCPServer:
             self.timer = None
         if self.socket:
             self.socket.close()
+        if self.unix_socket:
+            self.unix_socket.close()
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
         for client in self.clients:
             client.close()
+        if self.selector:
+            self.selector.close()
+            self.selector = None
+        if self.document_observer:
+            try:
+                App.removeDocumentObserver(self.document_observer)
+            except Exception:
+                pass
+            self.document_observer = None
+        self._close_scratch_pool()
+        self.object_revisions = {}
+        self.spatial_indexes = {}
+        self.spatial_dirty = {}
+        self.mesh_cache.clear()
+        self.mesh_cache_bytes = 0
+        if self.trace_recorder:
+            self.trace_recorder.close()
+            log_message(f"命令轨迹已保存 ({self.trace_recorder.count} 条): {self.trace_path}")
+            self.trace_recorder = None
+        for client, _, _ in self.pending_connections:
+            client.close()
+        self.pending_connections.clear()
         self.socket = None
-        self.clients = []
+        self.unix_socket = None
+        self.clients = set()
         self.buffer = {}
+        self.client_protocols = {}
+        self.client_timeouts = TimerWheel(tick=0.5, now=time.time())
+        self.job_waiters = {}
+        self.client_waiters = {}
+        self.waiter_timers = TimerWheel(tick=0.5, now=time.time())
+        self.scheduler = CommandScheduler(self.scheduler.policy, self.scheduler.max_inflight_per_client)
         log_message("FreeCAD MCP 服务器已停止")
 
     def _process_server(self):
-        if not self.running:
+        if not self.running or self._processing:
             return
+        self._processing = True
         try:
-            # 接受新连接
-            try:
-                client, address = self.socket.accept()
-                # 检查最大连接数限制
-                if len(self.clients) >= self.max_clients:
-                    log_message(f"达到最大连接数限制，拒绝连接: {address}")
-                    client.close()
-                else:
-                    client.setblocking(False)
-                    client.settimeout(self.connection_timeout)  # 设置超时
-                    self.clients.append(client)
-                    self.buffer[client] = b''
-                    self.client_timeouts[client] = time.time()  # 记录连接时间
-                    log_message(f"连接到客户端: {address}")
-            except BlockingIOError:
-                pass
+            # 接受新连接，空出名额时优先接纳排队中的连接
+            self._admit_pending_connections()
+            for listener in (self.socket, self.unix_socket):
+                if listener:
+                    self._accept_clients(listener)
             
-            # 处理现有客户端
-            for client in self.clients[:]:
+            # 处理现有客户端，只读取有数据到达的连接，开销与空闲连接数无关
+            readable = [key.fileobj for key, _ in self.selector.select(0)] if self.clients else []
+            for client in readable:
+                if client not in self.clients:
+                    continue  # 本轮中已被清理
                 try:
                     data = client.recv(self.buffer_size)
                     if data:
+                        received_at = time.time()
                         self.buffer[client] += data
                         # 检查缓冲区大小，防止内存溢出
                         if len(self.buffer[client]) > self.max_buffer_size:
@@ -139,77 +463,551 @@ class FreeCADMCPServer:
                             continue
                         
                         # 更新客户端活动时间
-                        self.client_timeouts[client] = time.time()
-                        
-                        try:
-                            command = json.loads(self.buffer[client].decode('utf-8'))
-                            self.buffer[client] = b''
-                            response = self.execute_command(command)
-                            response_json = json.dumps(response, ensure_ascii=False)
-                            client.sendall(response_json.encode('utf-8'))
-                        except json.JSONDecodeError:
-                            # 数据可能不完整，继续等待
-                            pass
-                        except UnicodeDecodeError as e:
-                            log_error(f"编码错误: {str(e)}")
-                            self._cleanup_client(client)
+                        self.client_timeouts.touch(client, received_at + self.connection_timeout)
+                        self._process_client_buffer(client, received_at)
                     else:
                         log_message("客户端断开连接")
                         self._cleanup_client(client)
-                except BlockingIOError:
+                except (BlockingIOError, socket.timeout):
                     pass
                 except Exception as e:
                     log_error(f"处理客户端数据错误: {str(e)}")
                     self._cleanup_client(client)
             
+            # 按调度策略执行排队的命令
+            self._dispatch_commands()
+            
             # 检查客户端超时
+            self._check_job_waiters()
             self._check_client_timeouts()
         except Exception as e:
             log_error(f"服务器处理错误: {str(e)}")
+        finally:
+            self._processing = False
+
+    def _process_client_buffer(self, client, received_at=None):
+        """从客户端缓冲区中取出完整的消息并依次执行；received_at 为数据到达时间，随排队命令保存"""
+        while self.buffer.get(client):
+            if client not in self.client_protocols and self.buffer[client][:1] == protocol.MAGIC[:1]:
+                # 缓存了协商结果的客户端不再握手，直接发送帧；按请求帧的编码回复
+                if len(self.buffer[client]) < protocol.HEADER.size:
+                    return
+                try:
+                    _, encoding, _, _ = protocol.parse_header(self.buffer[client][:protocol.HEADER.size])
+                    if protocol.ENCODING_NAMES.get(encoding) not in protocol.supported_encodings():
+                        raise protocol.ProtocolError(f"不支持的编码: {encoding}")
+                except Exception as e:
+                    log_error(f"帧解码错误: {str(e)}")
+                    self._cleanup_client(client)
+                    return
+                self.client_protocols[client] = {
+                    "encoding": protocol.ENCODING_NAMES[encoding],
+                    "compress_threshold": self.compress_threshold,
+                    "stream": True
+                }
+            if client in self.client_protocols:
+                try:
+                    command, consumed = protocol.decode_frame(self.buffer[client])
+                except Exception as e:
+                    log_error(f"帧解码错误: {str(e)}")
+                    self._cleanup_client(client)
+                    return
+                if command is None:
+                    return
+                self.buffer[client] = self.buffer[client][consumed:]
+            else:
+                try:
+                    command = protocol.from_json_compatible(json.loads(self.buffer[client].decode('utf-8')))
+                except json.JSONDecodeError:
+                    # 数据可能不完整，继续等待
+                    return
+                except UnicodeDecodeError as e:
+                    log_error(f"编码错误: {str(e)}")
+                    self._cleanup_client(client)
+                    return
+                self.buffer[client] = b''
+            if command.get("type") not in self.immediate_commands:
+                # 其余命令进入该客户端的队列，由 _dispatch_commands 公平调度
+                try:
+                    self.scheduler.submit(self._client_key(client, command), command, client, received_at)
+                except SchedulerFull as e:
+                    self._send_response(client, self._tag_response(command, {"result": "error", "message": str(e), "busy": True}))
+                continue
+            response = self._execute_and_respond(client, command, received_at)
+            # hello 的响应仍以 JSON 文本发送，之后该连接切换到二进制帧
+            if command.get("type") == "hello" and response and response.get("result") == "success":
+                self.client_protocols[client] = {
+                    "encoding": response["encoding"],
+                    "compress_threshold": response["compress_threshold"] if response["compression"] else None,
+                    "stream": response.get("stream", False)
+                }
+
+    def _execute_and_respond(self, client, command, received_at=None):
+        """执行命令并发送响应；延迟响应的命令（如 wait_job）返回 None，稍后由服务器主动发送"""
+        response = self.execute_command(command, client, received_at)
+        if response is None:
+            return None
+        self._send_response(client, self._tag_response(command, response))
+        return response
+
+    def _tag_response(self, command, response):
+        """请求带有 id 时在响应中回传，便于流水线客户端对应请求和响应"""
+        if command.get("id") is not None:
+            response["id"] = command["id"]
+        return response
+
+    def _dispatch_commands(self):
+        """在客户端之间轮转执行排队的命令；任务执行期间暂停，命令留在队列中"""
+        if self._dispatching:
+            return
+        self._dispatching = True
+        try:
+            deadline = time.time() + self.dispatch_budget
+            while not self.active_job:
+                entry = self.scheduler.next()
+                if entry is None:
+                    break
+                owner, client, _, command, received_at = entry
+                try:
+                    self._execute_and_respond(client, command, received_at)
+                except Exception as e:
+                    log_error(f"处理客户端命令错误: {str(e)}")
+                    self._cleanup_client(client)
+                finally:
+                    self.scheduler.complete(owner)
+                if time.time() >= deadline:
+                    break
+        finally:
+            self._dispatching = False
+        if self.job_queue and not self.active_job:
+            QTimer.singleShot(0, self._run_next_job)
+
+    def _client_key(self, client, command):
+        """
+        调度和权限使用的客户端标识
+
+        客户端每条命令使用一个新连接，因此以命令中的 client_id（每个客户端进程一个）区分客户端；
+        未提供 client_id 的客户端按连接区分。
+        """
+        client_id = command.get("client_id")
+        if client_id:
+            return ("client_id", str(client_id)[:64])
+        return client
+
+    def handle_cancel_request(self, owner, request_id):
+        """取消本客户端尚未执行的命令，被取消的请求会在其所在连接上收到 cancelled 响应"""
+        entry = self.scheduler.cancel(owner, request_id) if owner is not None else None
+        if entry is None:
+            return {"result": "error", "message": f"请求不在本客户端的队列中（可能已执行）: {request_id}", "cancelled": False}
+        connection, command = entry
+        try:
+            self._send_response(connection, self._tag_response(command, {"result": "error", "message": "请求已取消", "cancelled": True}))
+        except OSError:
+            self._cleanup_client(connection)
+        log_message(f"已取消排队中的请求: {request_id}")
+        return {"result": "success", "cancelled": True, "request_id": request_id}
+
+    def handle_list_requests(self, owner):
+        """列出本客户端排队等待执行的请求，供 cancel_request 使用；其他客户端只报告总数"""
+        requests = []
+        now = time.time()
+        for request_id, connection, command, received_at in (self.scheduler.queued(owner) if owner is not None else ()):
+            params = command.get("params") or {}
+            requests.append({
+                "request_id": request_id,
+                "type": command.get("type"),
+                "connection": self.client_ids.get(connection),
+                "target": params.get("macro_path") or params.get("macro_name") or params.get("doc_name"),
+                "priority": command.get("priority", 0),
+                "queued_seconds": round(now - received_at, 3) if received_at else None
+            })
+        return {
+            "result": "success",
+            "requests": requests,
+            "queued_total": len(self.scheduler),
+            "running_job": self.active_job["job_id"] if self.active_job else None
+        }
+
+    def _send_response(self, client, response):
+        """按客户端协商的协议编码并发送响应"""
+        settings = self.client_protocols.get(client)
+        if settings:
+            data = protocol.encode_frame(response, settings["encoding"], settings["compress_threshold"])
+        else:
+            data = protocol.encode_json_text(response)
+        client.sendall(data)
+
+    def _accept_clients(self, listener):
+        """从监听套接字(TCP 或 Unix)接受所有已到达的连接，超出上限时排队而不是直接关闭"""
+        while True:
+            try:
+                client, address = listener.accept()
+            except BlockingIOError:
+                return
+            # Unix 套接字的对端地址为空字符串
+            address = address or self.socket_path
+            if len(self.clients) < self.max_clients and not self.pending_connections:
+                self._register_client(client, address)
+            elif len(self.pending_connections) < self.max_pending_connections:
+                self.pending_connections.append((client, address, time.time()))
+                log_message(f"达到最大连接数限制，连接排队等待: {address}")
+            else:
+                log_message(f"连接等待队列已满，拒绝连接: {address}")
+                client.close()
+
+    def _admit_pending_connections(self):
+        """有空闲名额时按到达顺序接纳排队的连接，丢弃等待超时的连接"""
+        now = time.time()
+        while self.pending_connections:
+            client, address, queued_at = self.pending_connections[0]
+            if now - queued_at > self.connection_timeout:
+                self.pending_connections.popleft()
+                log_message(f"排队连接等待超时，断开: {address}")
+                client.close()
+                continue
+            if len(self.clients) >= self.max_clients:
+                return
+            self.pending_connections.popleft()
+            self._register_client(client, address)
+
+    def _register_client(self, client, address):
+        client.setblocking(False)
+        client.settimeout(self.connection_timeout)  # 设置超时
+        self.clients.add(client)
+        self.selector.register(client, selectors.EVENT_READ)
+        self.buffer[client] = b''
+        self.client_ids[client] = next(self._client_seq)
+        self.client_timeouts.schedule(client, time.time() + self.connection_timeout)
+        log_message(f"连接到客户端: {address}")
 
     def _cleanup_client(self, client):
         """清理客户端连接的辅助方法"""
         try:
             if client in self.clients:
-                self.clients.remove(client)
-            if client in self.buffer:
-                del self.buffer[client]
-            if client in self.client_timeouts:
-                del self.client_timeouts[client]
+                self.clients.discard(client)
+                if self.selector:
+                    self.selector.unregister(client)
+            self.buffer.pop(client, None)
+            self.client_ids.pop(client, None)
+            self.client_timeouts.remove(client)
+            self.client_protocols.pop(client, None)
+            for waiter in list(self.client_waiters.get(client, ())):
+                self._drop_job_waiter(waiter)
+            self.scheduler.remove_connection(client)
             client.close()
         except Exception as e:
             log_error(f"清理客户端连接时出错: {str(e)}")
     
     def _check_client_timeouts(self):
-        """检查并清理超时的客户端连接"""
-        current_time = time.time()
-        timeout_clients = []
-        
-        for client, last_activity in self.client_timeouts.items():
-            if current_time - last_activity > self.connection_timeout:
-                timeout_clients.append(client)
-        
-        for client in timeout_clients:
+        """检查并清理超时的客户端连接，只处理时间轮中本轮到期的连接"""
+        for client in self.client_timeouts.advance(time.time()):
             log_message("客户端连接超时，断开连接")
             self._cleanup_client(client)
 
-    def execute_command(self, command):
+    def execute_command(self, command, client=None, received_at=None):
+        """
+        执行命令；开启轨迹记录时记录来自客户端的请求和响应
+
+        轨迹中的时间是命令到达的时间而不是开始执行的时间，重放时按客户端的真实到达节奏发送；
+        在调度队列中或任务之后等待的时间单独记录为 wait。
+        """
+        if not self.trace_recorder or client is None:
+            return self._route_command(command, client)
+        started = time.time()
+        if received_at is None:
+            received_at = started
+        response = self._route_command(command, client)
+        try:
+            self.trace_recorder.record(self.client_ids.get(client), received_at, started - received_at,
+                                       time.time() - started, command, response)
+        except Exception as e:
+            log_error(f"写入命令轨迹错误，停止记录: {str(e)}")
+            self.trace_recorder.close()
+            self.trace_recorder = None
+        return response
+
+    def _route_command(self, command, client=None):
         command_type = command.get("type")
         params = command.get("params", {})
         if command_type == "create_macro":
             return self.handle_create_macro(params.get("macro_name"), params.get("template_type"))
         elif command_type == "update_macro":
             return self.handle_update_macro(params.get("macro_name"), params.get("code"))
+        elif command_type == "get_macro_hash":
+            return self.handle_get_macro_hash(params.get("macro_name"))
+        elif command_type == "patch_macro":
+            return self.handle_patch_macro(params.get("macro_name"), params.get("base_hash"),
+                                           params.get("edits"), params.get("diff"))
         elif command_type == "run_macro":
-            return self.handle_run_macro(params.get("macro_path"), params.get("params"))
+            with self._capture_output(client, command) as capture:
+                response = self.handle_run_macro(params.get("macro_path"), params.get("params"), params.get("profile"))
+            return self._attach_output(response, capture)
         elif command_type == "validate_macro_code":
-            return self.handle_validate_macro_code(params.get("macro_name"), params.get("code"))
+            with self._capture_output(client, command) as capture:
+                response = self.handle_validate_macro_code(params.get("macro_name"), params.get("code"), params.get("profile"))
+            return self._attach_output(response, capture)
+        elif command_type == "rollback_checkpoint":
+            return self.handle_rollback_checkpoint(params.get("doc_name"), params.get("checkpoint"))
+        elif command_type == "list_checkpoints":
+            return self.handle_list_checkpoints(params.get("doc_name"))
+        elif command_type == "list_documents":
+            return self.handle_list_documents(params.get("include_memory", False))
+        elif command_type == "get_mesh":
+            return self.handle_get_mesh(params.get("doc_name"), params.get("object_names"),
+                                        params.get("deviation"), params.get("lod", "medium"))
+        elif command_type == "query_region":
+            return self.handle_query_region(params.get("doc_name"), params.get("min"), params.get("max"),
+                                            params.get("contained", False), params.get("visible_only", False))
+        elif command_type == "nearest_objects":
+            return self.handle_nearest_objects(params.get("doc_name"), params.get("point"), params.get("k", 5),
+                                               params.get("max_distance"), params.get("visible_only", False))
+        elif command_type == "collision_candidates":
+            return self.handle_collision_candidates(params.get("doc_name"), params.get("object_names"),
+                                                    params.get("tolerance", 0.0), params.get("visible_only", True),
+                                                    params.get("max_pairs", 1000))
         elif command_type == "set_view":
             return self.handle_set_view(params.get("view_type"))
         elif command_type == "get_report":
             return self.handle_get_report()
+        elif command_type == "hello":
+            return self.handle_hello(params)
+        elif command_type == "submit_job":
+            return self.handle_submit_job(params.get("command"))
+        elif command_type == "job_status":
+            return self.handle_job_status(params.get("job_id"))
+        elif command_type == "wait_job":
+            return self.handle_wait_job(params.get("job_id"), params.get("timeout", 60), client, command.get("id"))
+        elif command_type == "cancel_job":
+            return self.handle_cancel_job(params.get("job_id"))
+        elif command_type == "list_requests":
+            return self.handle_list_requests(self._client_key(client, command) if client else None)
+        elif command_type == "cancel_request":
+            return self.handle_cancel_request(self._client_key(client, command) if client else None,
+                                              params.get("request_id"))
+        elif command_type == "ping":
+            return {
+                "result": "success",
+                "message": "pong",
+                "time": time.time(),
+                # 多服务器路由的客户端据此选择负载最低的实例
+                "load": {
+                    "queued": len(self.scheduler),
+                    "jobs": len(self.job_queue) + (1 if self.active_job else 0),
+                    "clients": len(self.clients)
+                }
+            }
         return {"result": "error", "message": f"未知命令: {command_type}"}
 
+    def handle_hello(self, params):
+        """协商二进制编码和压缩方式；客户端缓存结果后新连接直接发送帧，未握手也不发送帧的客户端使用 JSON 文本"""
+        encoding = protocol.negotiate(params.get("encodings"), protocol.supported_encodings())
+        if not encoding:
+            return {"result": "error", "message": f"没有可用的编码，服务器支持: {protocol.supported_encodings()}"}
+        compression = protocol.negotiate(params.get("compression"), protocol.supported_compression())
+        return {
+            "result": "success",
+            "protocol": protocol.PROTOCOL_VERSION,
+            "encoding": encoding,
+            "compression": compression,
+            "compress_threshold": self.compress_threshold,
+            # 客户端请求时启用执行期间的增量输出帧
+            "stream": bool(params.get("stream"))
+        }
+
+    def handle_submit_job(self, command):
+        """提交异步任务，立即返回任务 ID"""
+        if not isinstance(command, dict) or command.get("type") not in self.job_commands:
+            return {"result": "error", "message": f"只能提交以下命令作为任务: {sorted(self.job_commands)}"}
+        self._prune_jobs()
+        job_id = uuid.uuid4().hex[:12]
+        self.jobs[job_id] = {
+            "job_id": job_id,
+            "command": command,
+            "status": "queued",
+            "progress": 0.0,
+            "progress_message": "",
+            "submitted_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "result": None,
+            "cancel_requested": False
+        }
+        self.job_queue.append(job_id)
+        QTimer.singleShot(0, self._run_next_job)
+        log_message(f"任务已提交: {job_id} ({command['type']})")
+        return {"result": "success", "job_id": job_id, "status": "queued", "queue_position": len(self.job_queue)}
+
+    def handle_job_status(self, job_id):
+        job = self.jobs.get(job_id)
+        if not job:
+            return {"result": "error", "message": f"任务不存在或已过期: {job_id}"}
+        return self._job_status_response(job)
+
+    def handle_wait_job(self, job_id, timeout=60, client=None, request_id=None):
+        """等待任务结束；未结束时挂起响应，直到任务完成或超时"""
+        job = self.jobs.get(job_id)
+        if not job:
+            return {"result": "error", "message": f"任务不存在或已过期: {job_id}"}
+        if job["finished_at"] is not None or client is None or not timeout or timeout <= 0:
+            return self._job_status_response(job)
+        self._add_job_waiter(client, job_id, time.time() + float(timeout), request_id)
+        return None
+
+    def handle_cancel_job(self, job_id):
+        """取消任务：排队中的任务直接移除，运行中的任务在下一次 progress() 调用时中止"""
+        job = self.jobs.get(job_id)
+        if not job:
+            return {"result": "error", "message": f"任务不存在或已过期: {job_id}"}
+        if job["status"] == "queued":
+            self.job_queue.remove(job_id)
+            self._finish_job(job, "cancelled", {"result": "error", "message": "任务已取消", "cancelled": True})
+        elif job["status"] == "running":
+            job["cancel_requested"] = True
+            log_message(f"请求取消运行中的任务: {job_id}")
+        return self._job_status_response(job)
+
+    def _job_status_response(self, job):
+        response = {
+            "result": "success",
+            "job_id": job["job_id"],
+            "status": job["status"],
+            "progress": job["progress"],
+            "progress_message": job["progress_message"],
+            "submitted_at": job["submitted_at"],
+            "started_at": job["started_at"],
+            "finished_at": job["finished_at"]
+        }
+        if job["status"] == "queued":
+            response["queue_position"] = list(self.job_queue).index(job["job_id"]) + 1
+        if job["finished_at"] is not None:
+            response["job_result"] = job["result"]
+        elif job["status"] == "running" and self.active_capture:
+            # 运行中的任务返回最近的输出，便于轮询的客户端及早发现问题
+            response["output_tail"] = self.active_capture["stdout"].getvalue()[-2000:]
+        return response
+
+    def _run_next_job(self):
+        """执行队列中的下一个任务；任务之间回到事件循环，其他客户端的命令得以处理"""
+        # 有命令正在执行时（例如其中的 updateGui 触发了定时器）不嵌套启动任务，
+        # 由 _dispatch_commands 结束时重新调度
+        if not self.running or self.active_job or self._dispatching or not self.job_queue:
+            return
+        job = self.jobs[self.job_queue.popleft()]
+        job["status"] = "running"
+        job["started_at"] = time.time()
+        self.active_job = job
+        log_message(f"开始执行任务: {job['job_id']}")
+        try:
+            result = self.execute_command(job["command"])
+        except Exception as e:
+            result = {"result": "error", "message": str(e), "traceback": traceback.format_exc()}
+        finally:
+            self.active_job = None
+        # 只有宏确实在 progress() 处中止时才算取消；取消请求晚于最后一次 progress() 时
+        # 宏已完整执行并提交，按实际结果报告
+        if result.get("cancelled"):
+            status = "cancelled"
+        else:
+            status = "succeeded" if result.get("result") == "success" else "failed"
+        self._finish_job(job, status, result)
+        # 任务期间积压的命令按调度策略继续执行
+        self._dispatch_commands()
+        if self.job_queue:
+            QTimer.singleShot(0, self._run_next_job)
+
+    def _finish_job(self, job, status, result):
+        job["status"] = status
+        job["result"] = result
+        job["finished_at"] = time.time()
+        if status == "succeeded":
+            job["progress"] = 1.0
+        log_message(f"任务结束: {job['job_id']} ({status})")
+        for waiter in list(self.job_waiters.get(job["job_id"], ())):
+            self._respond_job_waiter(waiter)
+
+    def _add_job_waiter(self, client, job_id, deadline, request_id):
+        waiter = (client, job_id, request_id, next(self._waiter_ids))
+        self.job_waiters.setdefault(job_id, set()).add(waiter)
+        self.client_waiters.setdefault(client, set()).add(waiter)
+        self.waiter_timers.schedule(waiter, deadline)
+        # 等待期间连接不算空闲
+        self.client_timeouts.touch(client, deadline + self.connection_timeout)
+
+    def _drop_job_waiter(self, waiter):
+        client, job_id = waiter[0], waiter[1]
+        for registry, key in ((self.job_waiters, job_id), (self.client_waiters, client)):
+            waiters = registry.get(key)
+            if waiters is not None:
+                waiters.discard(waiter)
+                if not waiters:
+                    del registry[key]
+        self.waiter_timers.remove(waiter)
+
+    def _respond_job_waiter(self, waiter):
+        """向 wait_job 调用方发送任务当前状态"""
+        self._drop_job_waiter(waiter)
+        client, job_id, request_id, _ = waiter
+        job = self.jobs.get(job_id)
+        if job:
+            response = self._job_status_response(job)
+        else:
+            response = {"result": "error", "message": f"任务不存在或已过期: {job_id}"}
+        if request_id is not None:
+            response["id"] = request_id
+        try:
+            self._send_response(client, response)
+        except Exception as e:
+            log_error(f"发送任务状态错误: {str(e)}")
+
+    def _check_job_waiters(self):
+        """向等待超时的 wait_job 调用方返回任务当前状态"""
+        for waiter in self.waiter_timers.advance(time.time()):
+            self._respond_job_waiter(waiter)
+
+    def _prune_jobs(self):
+        """清理过期的已完成任务，限制保留数量"""
+        now = time.time()
+        finished = [j for j in self.jobs.values() if j["finished_at"] is not None]
+        excess = len(finished) - self.max_finished_jobs
+        for job in finished:
+            if excess > 0 or now - job["finished_at"] > self.job_result_ttl:
+                del self.jobs[job["job_id"]]
+                excess -= 1
+
+    def report_progress(self, fraction=None, message=""):
+        """
+        宏中可调用的 progress() 辅助函数
+
+        在任务中执行时记录进度，并定期让出事件循环以响应状态查询和取消请求。
+        """
+        capture = self.active_capture
+        if capture and capture["closed"]:
+            raise StreamClosed("客户端已断开，终止宏执行")
+        if capture and capture["stream"]:
+            capture["stdout"].flush()
+            capture["stderr"].flush()
+            update = {"stream": "progress", "message": str(message) if message else ""}
+            if fraction is not None:
+                update["fraction"] = max(0.0, min(1.0, float(fraction)))
+            self._send_stream(capture, update)
+        job = self.active_job
+        if not job:
+            return
+        if fraction is not None:
+            job["progress"] = max(0.0, min(1.0, float(fraction)))
+        if message:
+            job["progress_message"] = str(message)
+        now = time.time()
+        if now - self._last_progress_events >= self.progress_interval:
+            self._last_progress_events = now
+            self._in_progress_events = True
+            try:
+                QCoreApplication.processEvents()
+            finally:
+                self._in_progress_events = False
+        if job["cancel_requested"]:
+            raise JobCancelled(f"任务已取消: {job['job_id']}")
+
     def handle_create_macro(self, macro_name, template_type="default"):
         try:
             macro_dir = App.getUserMacroDir()
@@ -233,15 +1031,72 @@ class FreeCADMCPServer:
         try:
             macro_dir = App.getUserMacroDir()
             macro_path = os.path.join(macro_dir, f"{macro_name}.FCMacro")
-            with open(macro_path, "w", encoding='utf-8') as f:
-                f.write(code)
+            self._write_macro_atomic(macro_path, code)
             log_message(f"宏文件更新成功: {macro_path}")
-            return {"result": "success", "message": f"宏文件更新成功: {macro_path}"}
+            return {"result": "success", "message": f"宏文件更新成功: {macro_path}", "hash": protocol.content_hash(code)}
         except Exception as e:
             log_error(f"更新宏文件错误: {str(e)}")
             return {"result": "error", "message": str(e), "traceback": traceback.format_exc()}
 
-    def handle_run_macro(self, macro_path, params):
+    def handle_get_macro_hash(self, macro_name):
+        """返回服务器上宏文件的内容哈希，客户端据此跳过未变化的上传"""
+        try:
+            macro_path = os.path.join(App.getUserMacroDir(), f"{macro_name}.FCMacro")
+            if not os.path.exists(macro_path):
+                return {"result": "success", "exists": False, "hash": None}
+            with open(macro_path, 'r', encoding='utf-8') as f:
+                code = f.read()
+            return {"result": "success", "exists": True, "hash": protocol.content_hash(code)}
+        except Exception as e:
+            log_error(f"读取宏文件哈希错误: {str(e)}")
+            return {"result": "error", "message": str(e), "traceback": traceback.format_exc()}
+
+    def handle_patch_macro(self, macro_name, base_hash, edits=None, diff=None):
+        """基于内容哈希增量修改宏文件，基线版本不一致时拒绝修改"""
+        try:
+            macro_path = os.path.join(App.getUserMacroDir(), f"{macro_name}.FCMacro")
+            if not os.path.exists(macro_path):
+                return {"result": "error", "message": f"宏文件不存在: {macro_path}"}
+            with open(macro_path, 'r', encoding='utf-8') as f:
+                code = f.read()
+            current_hash = protocol.content_hash(code)
+            if base_hash != current_hash:
+                log_error(f"宏文件基线版本已过期: {macro_name}")
+                return {"result": "error", "message": "基线版本已过期，请重新获取宏内容", "stale": True, "hash": current_hash}
+            if bool(edits) == bool(diff):
+                return {"result": "error", "message": "必须且只能提供 edits 或 diff 之一"}
+            lines = code.splitlines()
+            new_lines = apply_line_edits(lines, edits) if edits else apply_unified_diff(lines, diff)
+            new_code = "\n".join(new_lines)
+            if new_lines and (code.endswith("\n") or not lines):
+                new_code += "\n"
+            self._write_macro_atomic(macro_path, new_code)
+            new_hash = protocol.content_hash(new_code)
+            log_message(f"宏文件增量更新成功: {macro_path} ({len(lines)} -> {len(new_lines)} 行)")
+            return {"result": "success", "message": f"宏文件增量更新成功: {macro_path}", "hash": new_hash, "line_count": len(new_lines)}
+        except ValueError as e:
+            log_error(f"应用宏补丁错误: {str(e)}")
+            return {"result": "error", "message": str(e)}
+        except Exception as e:
+            log_error(f"增量更新宏文件错误: {str(e)}")
+            return {"result": "error", "message": str(e), "traceback": traceback.format_exc()}
+
+    def _write_macro_atomic(self, macro_path, code):
+        """写入同目录临时文件后原子替换，避免读到写了一半的宏"""
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(macro_path), prefix=".mcp_", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding='utf-8') as f:
+                f.write(code)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, macro_path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+
+    def handle_run_macro(self, macro_path, params, profile=None):
+        profiled = None
         try:
             # 智能路径处理 - 支持相对路径和绝对路径
             original_macro_path = macro_path
@@ -290,11 +1145,17 @@ class FreeCADMCPServer:
                 log_error(f"无效的宏文件扩展名: {macro_path}")
                 return {"result": "error", "message": "宏文件必须以.FCMacro结尾"}
             
+            # 试运行在临时文档中执行，不修改任何用户文档
+            if params and params.get("dry_run"):
+                return self._dry_run_macro(macro_path, profile)
+            
             # 获取和验证文档名称
             doc_name = self._get_document_name(macro_path, params)
             
             # 文档管理
             doc_created = False
+            doc = None
+            transaction = None
             try:
                 existing_doc = App.getDocument(doc_name) if doc_name in App.listDocuments() else None
                 
@@ -311,33 +1172,456 @@ class FreeCADMCPServer:
                 if not App.ActiveDocument:
                     raise Exception("无法设置活动文档")
                 
-                # 执行宏文件
-                self._execute_macro_file(macro_path)
+                # 整次运行放在一个文档事务中，失败时原地回滚而不是关闭文档
+                doc = App.ActiveDocument
+                transaction = self._open_transaction(doc, f"MCP {os.path.basename(macro_path)} {uuid.uuid4().hex[:8]}")
                 
-                # 重新计算和更新视图
-                self._update_document_view()
+                # 执行宏文件并重新计算、更新视图；开启剖析时两者都计入，以区分宏代码和 recompute 的耗时
+                with self._profiling(profile, os.path.splitext(os.path.basename(macro_path))[0]) as profiled:
+                    # 只记录宏自己创建的文档，用户同时在 GUI 中打开的文档不受 LRU 管理
+                    self.run_created_documents = set()
+                    try:
+                        self._execute_macro_file(macro_path)
+                    finally:
+                        created_documents, self.run_created_documents = self.run_created_documents, None
+                    self._update_document_view()
                 
+                if transaction:
+                    doc.commitTransaction()
                 log_message(f"宏文件 {macro_path} 执行成功于文档 {doc_name}")
-                return {"result": "success", "message": f"宏执行成功于文档 {doc_name}", "document": doc_name}
+                response = {"result": "success", "message": f"宏执行成功于文档 {doc_name}", "document": doc_name}
                 
-            except Exception as e:
-                # 如果是新创建的文档且执行失败，清理文档
-                if doc_created and App.ActiveDocument and App.ActiveDocument.Name == doc_name:
+                checkpoint = params.get("checkpoint") if params else None
+                if checkpoint:
+                    response["checkpoint"] = self._record_checkpoint(doc, checkpoint, transaction)
+                
+            except (Exception, *MACRO_ABORTS) as e:
+                if transaction and self._abort_transaction(doc):
+                    # 回滚后文档保持运行前的状态，重试时无需重建已有几何
+                    log_message(f"宏执行失败，已回滚文档: {doc_name}")
+                    if doc_created:
+                        self._touch_document(doc_name)
+                elif doc_created and App.ActiveDocument and App.ActiveDocument.Name == doc_name:
+                    # 无法使用事务时，清理新创建的文档
                     try:
                         App.closeDocument(doc_name)
                         log_message(f"清理失败的文档: {doc_name}")
                     except:
                         pass
                 raise e
+            
+            # 记录本次创建（包括宏内部创建）和使用的文档，超出数量或内存预算时关闭最久未用的文档
+            open_documents = App.listDocuments()
+            for name in created_documents:
+                if name in open_documents:
+                    self._touch_document(name)
+            if doc_created or doc_name in self.managed_documents:
+                self._touch_document(doc_name)
+            evicted, kept = self._enforce_document_limits(keep={doc_name})
+            if evicted:
+                response["evicted_documents"] = evicted
+            if kept:
+                response["unsaved_documents_kept"] = kept
+            return self._with_profile(response, profiled)
                 
+        except JobCancelled as e:
+            # 文档事务已在上面回滚
+            log_message(f"宏执行已取消: {str(e)}")
+            return self._with_profile({"result": "error", "message": str(e), "cancelled": True}, profiled)
+        except StreamClosed as e:
+            # 客户端已断开，响应通常无法送达，仍按常规返回以便轨迹和任务记录
+            return self._with_profile({"result": "error", "message": str(e)}, profiled)
         except Exception as e:
             log_error(f"运行宏错误: {str(e)}")
+            return self._with_profile({"result": "error", "message": str(e), "traceback": traceback.format_exc()}, profiled)
+
+    def _open_transaction(self, doc, name):
+        """在文档上打开事务，返回事务名称；文档不支持撤销时返回 None"""
+        try:
+            if not doc.UndoMode:
+                doc.UndoMode = 1
+            doc.openTransaction(name)
+            return name
+        except Exception as e:
+            log_error(f"无法打开文档事务，失败时将无法回滚: {str(e)}")
+            return None
+
+    def _abort_transaction(self, doc):
+        """放弃事务中的全部修改，文档回到运行前的状态"""
+        try:
+            doc.abortTransaction()
+            doc.recompute()
+            return True
+        except Exception as e:
+            log_error(f"回滚文档事务失败: {str(e)}")
+            return False
+
+    def _record_checkpoint(self, doc, checkpoint, transaction):
+        """把本次运行的事务记为检查点，之后可用 rollback_checkpoint 撤销到此处"""
+        if not transaction:
+            return {"name": checkpoint, "recorded": False, "message": "文档不支持撤销，无法记录检查点"}
+        checkpoints = self.checkpoints.setdefault(doc.Name, OrderedDict())
+        # 同名检查点重新记录时移到最后，保持按时间排序
+        checkpoints.pop(checkpoint, None)
+        checkpoints[checkpoint] = transaction
+        log_message(f"记录检查点 {checkpoint}: {doc.Name}")
+        return {"name": checkpoint, "recorded": True}
+
+    def handle_rollback_checkpoint(self, doc_name, checkpoint):
+        """撤销检查点之后的所有事务，保留检查点及之前已构建的几何"""
+        try:
+            if doc_name not in App.listDocuments():
+                return {"result": "error", "message": f"文档不存在: {doc_name}"}
+            transaction = self.checkpoints.get(doc_name, {}).get(checkpoint)
+            if not transaction:
+                return {"result": "error", "message": f"检查点不存在: {checkpoint}"}
+            doc = App.getDocument(doc_name)
+            # UndoNames 按从新到旧排列
+            if transaction not in doc.UndoNames:
+                return {"result": "error", "message": f"检查点已超出撤销栈范围: {checkpoint}"}
+            undone = 0
+            while doc.UndoNames and doc.UndoNames[0] != transaction:
+                doc.undo()
+                undone += 1
+            doc.recompute()
+            # 之后记录的检查点已被撤销
+            names = list(self.checkpoints[doc_name])
+            for name in names[names.index(checkpoint) + 1:]:
+                del self.checkpoints[doc_name][name]
+            if doc_name in self.managed_documents:
+                self._touch_document(doc_name)
+            log_message(f"回滚到检查点 {checkpoint}: {doc_name}，撤销 {undone} 个事务")
+            return {"result": "success", "document": doc_name, "checkpoint": checkpoint, "undone_transactions": undone}
+        except Exception as e:
+            log_error(f"回滚检查点错误: {str(e)}")
             return {"result": "error", "message": str(e), "traceback": traceback.format_exc()}
 
+    def handle_list_checkpoints(self, doc_name):
+        if doc_name not in App.listDocuments():
+            self.checkpoints.pop(doc_name, None)
+            return {"result": "error", "message": f"文档不存在: {doc_name}"}
+        return {"result": "success", "document": doc_name, "checkpoints": list(self.checkpoints.get(doc_name, {}))}
+
+    def _touch_document(self, doc_name):
+        """记录文档的最近使用时间和此时的撤销栈状态，并将其移到 LRU 队尾"""
+        now = time.time()
+        info = self.managed_documents.pop(doc_name, None) or {"created_at": now}
+        info["last_used"] = now
+        try:
+            info["undo_state"] = self._undo_state(App.getDocument(doc_name))
+        except Exception:
+            info["undo_state"] = None
+        self.managed_documents[doc_name] = info
+
+    def _undo_state(self, doc):
+        """撤销栈的长度和最新事务名称；MCP 的事务名称唯一，GUI 中的任何编辑都会改变它"""
+        undo_names = doc.UndoNames
+        return (len(undo_names), undo_names[0] if undo_names else None)
+
+    def _has_user_changes(self, doc_name):
+        """文档在 MCP 最后一次使用之后是否被修改过（例如用户在 GUI 中编辑）"""
+        try:
+            doc = App.getDocument(doc_name)
+            if doc.isTouched():
+                return True
+            return self._undo_state(doc) != self.managed_documents[doc_name].get("undo_state")
+        except Exception:
+            # 无法判断时按有修改处理，不冒丢失数据的风险
+            return True
+
+    def _estimate_document_memory(self, doc):
+        """估算文档中形状占用的内存(字节)，基于 OpenCascade 报告的 Shape.MemSize"""
+        total = 0
+        for obj in doc.Objects:
+            try:
+                shape = getattr(obj, "Shape", None)
+                if shape is not None and not shape.isNull():
+                    total += shape.MemSize
+            except Exception:
+                continue
+        return total
+
+    def _enforce_document_limits(self, keep=()):
+        """
+        关闭最久未用的受管文档，直到文档数量和内存估算都在限制之内
+
+        未开启 save_evicted_documents 时，MCP 最后一次使用之后被修改过的文档不会被关闭。
+        返回 (已关闭的文档, 因有未保存修改而保留的文档)。
+        """
+        open_documents = App.listDocuments()
+        # 用户已手动关闭的文档不再跟踪
+        for name in [n for n in self.managed_documents if n not in open_documents]:
+            del self.managed_documents[name]
+        
+        memory = {}
+        if self.document_memory_budget:
+            memory = {name: self._estimate_document_memory(App.getDocument(name)) for name in self.managed_documents}
+        budget = self.document_memory_budget * 1024 * 1024 if self.document_memory_budget else None
+        
+        evicted = []
+        kept = []
+        for name in list(self.managed_documents):
+            over_count = len(self.managed_documents) > self.max_documents
+            over_memory = budget is not None and sum(memory.values()) > budget
+            if not (over_count or over_memory):
+                break
+            if name in keep:
+                continue
+            if not self.save_evicted_documents and self._has_user_changes(name):
+                log_message(f"文档 {name} 有未保存的修改，不自动关闭")
+                kept.append(name)
+                continue
+            if self._close_managed_document(name):
+                evicted.append(name)
+                memory.pop(name, None)
+        return evicted, kept
+
+    def _close_managed_document(self, doc_name):
+        try:
+            doc = App.getDocument(doc_name)
+            if self.save_evicted_documents:
+                if doc.FileName:
+                    doc.save()
+                else:
+                    os.makedirs(self.evicted_document_dir, exist_ok=True)
+                    doc.saveAs(os.path.join(self.evicted_document_dir, f"{doc_name}.FCStd"))
+            App.closeDocument(doc_name)
+            del self.managed_documents[doc_name]
+            self.checkpoints.pop(doc_name, None)
+            log_message(f"关闭最久未使用的文档: {doc_name}")
+            return True
+        except Exception as e:
+            log_error(f"关闭文档 {doc_name} 失败: {str(e)}")
+            return False
+
+    def handle_list_documents(self, include_memory=False):
+        """列出已打开的文档及对象数量，标明由 MCP 管理的文档及其最近使用时间"""
+        try:
+            active = App.ActiveDocument.Name if App.ActiveDocument else None
+            documents = []
+            for name, doc in App.listDocuments().items():
+                info = {
+                    "name": name,
+                    "label": doc.Label,
+                    "object_count": len(doc.Objects),
+                    "file_name": doc.FileName,
+                    "active": name == active,
+                    "managed": name in self.managed_documents,
+                    "scratch": name in self.scratch_free or name in self.scratch_leased
+                }
+                if name in self.managed_documents:
+                    info["last_used"] = self.managed_documents[name]["last_used"]
+                if include_memory:
+                    info["shape_memory_bytes"] = self._estimate_document_memory(doc)
+                documents.append(info)
+            return {
+                "result": "success",
+                "documents": documents,
+                "max_documents": self.max_documents,
+                "memory_budget_mb": self.document_memory_budget
+            }
+        except Exception as e:
+            log_error(f"列出文档错误: {str(e)}")
+            return {"result": "error", "message": str(e), "traceback": traceback.format_exc()}
+
+    def _new_scratch_document(self):
+        name = f"MCPScratch_{next(self._scratch_seq)}"
+        try:
+            # 需要 3D 视图：宏可能使用 Gui.ActiveDocument.ActiveView；temp 不参与自动恢复
+            doc = App.newDocument(name, "MCP Scratch", False, True)
+        except TypeError:
+            # 旧版本 FreeCAD 不支持 hidden/temp 参数
+            doc = App.newDocument(name)
+        return doc.Name
+
+    def _warm_scratch_pool(self):
+        """服务器启动时预先创建临时文档"""
+        try:
+            while len(self.scratch_free) < self.scratch_pool_size:
+                self.scratch_free.append(self._new_scratch_document())
+        except Exception as e:
+            log_error(f"创建临时文档池失败: {str(e)}")
+
+    def _close_scratch_pool(self):
+        for name in list(self.scratch_free) + list(self.scratch_leased):
+            try:
+                if name in App.listDocuments():
+                    App.closeDocument(name)
+            except Exception:
+                pass
+        self.scratch_free.clear()
+        self.scratch_leased.clear()
+
+    def _clear_scratch_document(self, doc):
+        """删除临时文档中的全部对象和撤销记录，返回是否已清空"""
+        if hasattr(doc, "clearDocument"):
+            doc.clearDocument()
+        else:
+            for name in [obj.Name for obj in doc.Objects]:
+                if doc.getObject(name):
+                    doc.removeObject(name)
+        try:
+            doc.clearUndos()
+        except Exception:
+            pass
+        return not doc.Objects
+
+    @contextlib.contextmanager
+    def _scratch_document(self):
+        """
+        租用一个临时文档并设为活动文档（包括 GUI 活动文档），结束后清空并归还文档池
+
+        池中没有空闲文档时临时新建，归还时超出池大小的文档直接关闭。
+        租用期间宏对活动视图的操作只作用于临时文档，结束后恢复原来的活动文档。
+        """
+        open_documents = App.listDocuments()
+        previous = App.ActiveDocument.Name if App.ActiveDocument else None
+        previous_gui = Gui.ActiveDocument.Document.Name if App.GuiUp and Gui.ActiveDocument else None
+        # 用户可能手动关闭了池中的文档
+        while self.scratch_free and self.scratch_free[0] not in open_documents:
+            self.scratch_free.popleft()
+        name = self.scratch_free.popleft() if self.scratch_free else self._new_scratch_document()
+        self.scratch_leased.add(name)
+        try:
+            App.setActiveDocument(name)
+            if App.GuiUp:
+                Gui.setActiveDocument(name)
+            yield App.getDocument(name)
+        finally:
+            self.scratch_leased.discard(name)
+            self._release_scratch_document(name)
+            if previous and previous in App.listDocuments():
+                App.setActiveDocument(previous)
+            if previous_gui and previous_gui in App.listDocuments():
+                try:
+                    Gui.setActiveDocument(previous_gui)
+                except Exception as e:
+                    log_error(f"恢复活动文档 {previous_gui} 失败: {str(e)}")
+
+    def _release_scratch_document(self, name):
+        try:
+            if name not in App.listDocuments():
+                return
+            if len(self.scratch_free) < self.scratch_pool_size and self._clear_scratch_document(App.getDocument(name)):
+                self.scratch_free.append(name)
+            else:
+                App.closeDocument(name)
+        except Exception as e:
+            log_error(f"归还临时文档 {name} 失败: {str(e)}")
+            try:
+                App.closeDocument(name)
+            except Exception:
+                pass
+
+    def _dry_run_macro(self, macro_path, profile=None):
+        """在临时文档中执行宏并重新计算，报告生成的对象，不修改用户文档"""
+        profiled = None
+        try:
+            with self._scratch_document() as doc:
+                with self._profiling(profile, os.path.splitext(os.path.basename(macro_path))[0]) as profiled:
+                    self._execute_macro_file(macro_path)
+                    doc.recompute()
+                invalid = [obj.Name for obj in doc.Objects if "Invalid" in obj.State or "Error" in obj.State]
+                response = {
+                    "result": "success" if not invalid else "error",
+                    "message": f"试运行完成，生成 {len(doc.Objects)} 个对象" + (f"，{len(invalid)} 个对象计算失败" if invalid else ""),
+                    "dry_run": True,
+                    "object_count": len(doc.Objects),
+                    "invalid_objects": invalid
+                }
+        except JobCancelled as e:
+            log_message(f"宏试运行已取消: {str(e)}")
+            return self._with_profile({"result": "error", "message": str(e), "cancelled": True, "dry_run": True}, profiled)
+        except StreamClosed as e:
+            return self._with_profile({"result": "error", "message": str(e), "dry_run": True}, profiled)
+        except Exception as e:
+            log_error(f"宏试运行错误: {str(e)}")
+            return self._with_profile({"result": "error", "message": str(e), "dry_run": True,
+                                       "traceback": traceback.format_exc()}, profiled)
+        log_message(f"宏文件 {macro_path} 试运行完成")
+        return self._with_profile(response, profiled)
+
+    @contextlib.contextmanager
+    def _capture_output(self, client, command):
+        """
+        捕获命令执行期间的 stdout/stderr
+
+        请求参数 stream 为 True 且客户端在 hello 中协商了 stream 时，输出以
+        {"type": "stream", "id": 请求 ID, "stream": "stdout"|"stderr"|"progress", ...}
+        增量帧发送，最终响应在所有增量帧之后。客户端断开连接会在下一次输出或
+        progress() 时终止宏执行。
+        """
+        if self.active_capture is not None:
+            # 嵌套执行（如任务中的命令）共用外层的捕获
+            yield self.active_capture
+            return
+        settings = self.client_protocols.get(client) if client else None
+        stream = bool(settings and settings.get("stream") and (command.get("params") or {}).get("stream"))
+        capture = {"client": client, "id": command.get("id"), "stream": stream, "seq": 0, "closed": False}
+        sink = (lambda name, text: self._send_stream(capture, {"stream": name, "data": text})) if stream else None
+        capture["stdout"] = MacroOutputStream("stdout", sys.stdout, sink, self.output_max_chars, self.stream_flush_interval)
+        capture["stderr"] = MacroOutputStream("stderr", sys.stderr, sink, self.output_max_chars, self.stream_flush_interval)
+        self.active_capture = capture
+        try:
+            with contextlib.redirect_stdout(capture["stdout"]), contextlib.redirect_stderr(capture["stderr"]):
+                yield capture
+        finally:
+            self.active_capture = None
+            for name in ("stdout", "stderr"):
+                try:
+                    capture[name].flush()
+                except StreamClosed:
+                    pass
+
+    def _send_stream(self, capture, update):
+        """发送一条增量帧；客户端已断开时抛出 StreamClosed"""
+        client = capture["client"]
+        try:
+            if self._peer_closed(client):
+                raise ConnectionError("连接已关闭")
+            capture["seq"] += 1
+            frame = dict(update, type="stream", seq=capture["seq"])
+            if capture["id"] is not None:
+                frame["id"] = capture["id"]
+            self._send_response(client, frame)
+        except (OSError, ConnectionError, ValueError):
+            # 之后的输出只保留在缓冲中，宏在本次输出处被终止
+            capture["closed"] = True
+            capture["stream"] = False
+            capture["stdout"].sink = capture["stderr"].sink = None
+            # 宏即使用裸 except 捕获了本次异常，之后的每次输出和 progress() 仍会再次抛出
+            capture["stdout"].abort_error = capture["stderr"].abort_error = StreamClosed
+            log_message("流式输出的客户端已断开，终止宏执行")
+            raise StreamClosed("客户端已断开，终止宏执行")
+
+    def _peer_closed(self, client):
+        """非阻塞地窥探连接，读到 EOF 表示客户端已关闭；不用 select()，不受 FD_SETSIZE 限制"""
+        timeout = client.gettimeout()
+        client.settimeout(0)
+        try:
+            return client.recv(1, socket.MSG_PEEK) == b''
+        except (BlockingIOError, InterruptedError):
+            return False  # 没有待读数据，连接仍然打开
+        finally:
+            client.settimeout(timeout)
+
+    def _attach_output(self, response, capture):
+        """将捕获的输出附加到响应中"""
+        if response is None:
+            return response
+        stdout, stderr = capture["stdout"].getvalue(), capture["stderr"].getvalue()
+        if stdout:
+            response["stdout"] = stdout
+        if stderr:
+            response["stderr"] = stderr
+        if capture["stdout"].truncated or capture["stderr"].truncated:
+            response["output_truncated"] = True
+        if capture["closed"]:
+            response["aborted"] = True
+        return response
+
     def _get_document_name(self, macro_path, params):
         """获取并验证文档名称"""
-        import re
-        
         if params and "doc_name" in params and params["doc_name"]:
             doc_name = params["doc_name"]
         elif params is None and App.ActiveDocument:
@@ -365,7 +1649,8 @@ class FreeCADMCPServer:
                 "App": App,
                 "Gui": Gui,
                 "__name__": "__main__",
-                "__file__": macro_path
+                "__file__": macro_path,
+                "progress": self.report_progress
             }
             
             # 添加常用模块
@@ -377,11 +1662,107 @@ class FreeCADMCPServer:
                 "math": math
             })
             
-            exec(macro_code, safe_globals)
+            # 以宏文件路径编译，剖析结果和回溯中显示真实文件名
+            exec(compile(macro_code, macro_path, "exec"), safe_globals)
             
         except Exception as e:
+            # JobCancelled/StreamClosed 不是 Exception，原样传给调用方区分
             raise Exception(f"宏执行失败: {str(e)}")
 
+    @contextlib.contextmanager
+    def _profiling(self, profile, label):
+        """
+        按需用 cProfile（及可选的 tracemalloc）包裹代码块
+
+        产出一个字典，代码块结束（包括抛出异常）后其中的 "summary" 为剖析摘要，未剖析时为空；
+        每次调用各自持有结果，不经过服务器上的共享状态。
+        profile 为 True 或 {"top": N, "memory": bool}；完整结果另存为 .pstats 文件供离线分析。
+        """
+        result = {}
+        if not profile:
+            yield result
+            return
+        options = profile if isinstance(profile, dict) else {}
+        top_n = int(options.get("top", 20))
+        trace_memory = bool(options.get("memory", False))
+        started_tracing = False
+        if trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started_tracing = True
+            elif hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        profiler.enable()
+        try:
+            yield result
+        finally:
+            profiler.disable()
+            elapsed = time.perf_counter() - start
+            memory = None
+            if trace_memory:
+                current, peak = tracemalloc.get_traced_memory()
+                snapshot = tracemalloc.take_snapshot()
+                if started_tracing:
+                    tracemalloc.stop()
+                memory = {
+                    "current_bytes": current,
+                    "peak_bytes": peak,
+                    "top_allocations": [
+                        {"location": str(entry.traceback), "size_bytes": entry.size, "count": entry.count}
+                        for entry in snapshot.statistics("lineno")[:10]
+                    ]
+                }
+            try:
+                result["summary"] = self._profile_summary(profiler, label, elapsed, top_n, memory)
+            except Exception as e:
+                log_error(f"生成剖析结果错误: {str(e)}")
+
+    def _profile_summary(self, profiler, label, elapsed, top_n, memory):
+        """保存 .pstats 文件，返回按累计时间排序的前 N 个函数"""
+        os.makedirs(self.profile_dir, exist_ok=True)
+        safe_label = re.sub(r'[^\w\-]', '_', label) or "macro"
+        stats_path = os.path.join(self.profile_dir, f"{safe_label}_{time.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}.pstats")
+        profiler.dump_stats(stats_path)
+        self._prune_profile_files()
+        stats = pstats.Stats(profiler)
+        entries = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:top_n]
+        functions = [
+            {
+                "function": func,
+                "file": filename,
+                "line": line,
+                "calls": calls,
+                "primitive_calls": primitive_calls,
+                "total_time": round(total_time, 6),
+                "cumulative_time": round(cumulative_time, 6)
+            }
+            for (filename, line, func), (primitive_calls, calls, total_time, cumulative_time, _) in entries
+        ]
+        log_message(f"剖析完成: {label} 用时 {elapsed:.3f}s，结果保存到 {stats_path}")
+        summary = {"wall_time": round(elapsed, 6), "stats_file": stats_path, "top_functions": functions}
+        if memory:
+            summary["memory"] = memory
+        return summary
+
+    def _prune_profile_files(self):
+        files = sorted(
+            (os.path.join(self.profile_dir, name) for name in os.listdir(self.profile_dir) if name.endswith(".pstats")),
+            key=os.path.getmtime
+        )
+        for path in files[:-self.max_profile_files]:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def _with_profile(self, response, profiled):
+        """把 _profiling 产出的剖析摘要附加到响应中"""
+        if profiled and profiled.get("summary"):
+            response["profile"] = profiled["summary"]
+        return response
+
     def _update_document_view(self):
         """更新文档视图"""
         try:
@@ -395,7 +1776,246 @@ class FreeCADMCPServer:
         except Exception as e:
             log_error(f"更新视图失败: {str(e)}")
 
-    def handle_validate_macro_code(self, macro_name=None, code=None):
+    def _bump_revision(self, doc_name, obj_name):
+        self.object_revisions[(doc_name, obj_name)] = next(self._revision_seq)
+        if doc_name in self.spatial_indexes:
+            self.spatial_dirty[doc_name].add(obj_name)
+
+    def _forget_object(self, doc_name, obj_name):
+        # 删除后同名重建的对象会拿到新的修订号，不会命中旧缓存
+        self._bump_revision(doc_name, obj_name)
+        if doc_name in self.spatial_indexes:
+            self.spatial_dirty[doc_name].discard(obj_name)
+            self.spatial_indexes[doc_name].remove(obj_name)
+        for key in [k for k in self.mesh_cache if k[0] == doc_name and k[1] == obj_name]:
+            self._drop_mesh(key)
+
+    def _document_created(self, doc_name):
+        # progress() 处理事件期间用户在 GUI 中新建的文档不算宏创建的
+        if self.run_created_documents is not None and not self._in_progress_events:
+            self.run_created_documents.add(doc_name)
+
+    def _forget_document(self, doc_name):
+        for key in [k for k in self.object_revisions if k[0] == doc_name]:
+            del self.object_revisions[key]
+        self.spatial_indexes.pop(doc_name, None)
+        self.spatial_dirty.pop(doc_name, None)
+        for key in [k for k in self.mesh_cache if k[0] == doc_name]:
+            self._drop_mesh(key)
+
+    def _drop_mesh(self, key):
+        mesh = self.mesh_cache.pop(key, None)
+        if mesh:
+            self.mesh_cache_bytes -= len(mesh["vertices"]) + len(mesh["indices"])
+
+    def _tessellate_object(self, doc_name, obj, deviation, lod):
+        """返回对象的网格，修订号未变时直接使用缓存"""
+        precision = ("deviation", float(deviation)) if deviation else ("lod", lod)
+        key = (doc_name, obj.Name, precision)
+        revision = self.object_revisions.get((doc_name, obj.Name), 0)
+        mesh = self.mesh_cache.get(key)
+        if mesh and mesh["revision"] == revision:
+            self.mesh_cache.move_to_end(key)
+            return mesh, True
+        self._drop_mesh(key)
+        
+        shape = obj.Shape
+        if deviation:
+            tolerance = float(deviation)
+        else:
+            if lod not in self.mesh_lod_deviation:
+                raise ValueError(f"未知 lod 级别: {lod}，可选: {list(self.mesh_lod_deviation)}")
+            tolerance = max(shape.BoundBox.DiagonalLength * self.mesh_lod_deviation[lod], 1e-6)
+        points, facets = shape.tessellate(tolerance)
+        vertices, indices = pack_mesh(points, facets)
+        mesh = {
+            "revision": revision,
+            "deviation": tolerance,
+            "vertex_count": len(points),
+            "triangle_count": len(facets),
+            "vertices": vertices,
+            "indices": indices
+        }
+        size = len(vertices) + len(indices)
+        # 超过整个缓存预算的网格不缓存
+        if size <= self.mesh_cache_budget:
+            self.mesh_cache[key] = mesh
+            self.mesh_cache_bytes += size
+            while self.mesh_cache_bytes > self.mesh_cache_budget:
+                self._drop_mesh(next(iter(self.mesh_cache)))
+        return mesh, False
+
+    def handle_get_mesh(self, doc_name=None, object_names=None, deviation=None, lod="medium"):
+        """
+        细分对象形状并返回打包的网格
+
+        每个对象返回小端 float32 顶点数组 (x, y, z, ...) 和 uint32 三角形索引数组，
+        作为二进制附件传输（JSON 文本协议下为 base64）。未指定对象时返回文档中所有
+        带非空形状的可见对象。
+        """
+        try:
+            doc = App.getDocument(doc_name) if doc_name else App.ActiveDocument
+            if not doc:
+                return {"result": "error", "message": f"文档不存在: {doc_name}" if doc_name else "没有活动文档"}
+            if object_names:
+                objects = []
+                for name in object_names:
+                    obj = doc.getObject(name)
+                    if obj is None:
+                        return {"result": "error", "message": f"对象不存在: {name}"}
+                    objects.append(obj)
+            else:
+                objects = [obj for obj in doc.Objects if getattr(obj, "Visibility", True)]
+            
+            meshes = []
+            skipped = []
+            cache_hits = 0
+            for obj in objects:
+                shape = getattr(obj, "Shape", None)
+                if shape is None or shape.isNull():
+                    skipped.append(obj.Name)
+                    continue
+                mesh, cached = self._tessellate_object(doc.Name, obj, deviation, lod)
+                cache_hits += cached
+                meshes.append(dict(mesh, name=obj.Name, label=obj.Label, cached=cached))
+            log_message(f"细分 {len(meshes)} 个对象，缓存命中 {cache_hits} 个")
+            return {
+                "result": "success",
+                "doc_name": doc.Name,
+                "byte_order": "little",
+                "meshes": meshes,
+                "skipped": skipped,
+                "cache_hits": cache_hits
+            }
+        except Exception as e:
+            log_error(f"获取网格错误: {str(e)}")
+            return {"result": "error", "message": str(e), "traceback": traceback.format_exc()}
+
+    def _object_box(self, obj):
+        """对象形状的包围盒元组，没有有效形状时返回 None"""
+        shape = getattr(obj, "Shape", None)
+        if shape is None or shape.isNull():
+            return None
+        box = shape.BoundBox
+        if not box.isValid():
+            return None
+        return (box.XMin, box.YMin, box.ZMin, box.XMax, box.YMax, box.ZMax)
+
+    def _spatial_index(self, doc):
+        """返回文档的空间索引；首次使用时批量构建，之后只刷新观察者记录的变化对象"""
+        index = self.spatial_indexes.get(doc.Name)
+        dirty = self.spatial_dirty.get(doc.Name, ())
+        # 没有观察者时无法增量更新，每次重建；整体重新计算后变化的对象很多，
+        # 逐个插入会反复触发重建，直接批量构建更快
+        if index is None or self.document_observer is None or len(dirty) > index.rebuild_threshold():
+            index = SpatialIndex()
+            items = []
+            for obj in doc.Objects:
+                box = self._object_box(obj)
+                if box is not None:
+                    items.append((obj.Name, box))
+            index.bulk_load(items)
+            self.spatial_indexes[doc.Name] = index
+            self.spatial_dirty[doc.Name] = set()
+            log_message(f"为文档 {doc.Name} 构建空间索引: {len(index)} 个对象")
+            return index
+        for name in dirty:
+            obj = doc.getObject(name)
+            box = self._object_box(obj) if obj is not None else None
+            if box is None:
+                index.remove(name)
+            else:
+                index.insert(name, box)
+        dirty.clear()
+        return index
+
+    def _spatial_document(self, doc_name):
+        doc = App.getDocument(doc_name) if doc_name else App.ActiveDocument
+        if not doc:
+            raise ValueError(f"文档不存在: {doc_name}" if doc_name else "没有活动文档")
+        return doc
+
+    def _visible(self, doc, name):
+        obj = doc.getObject(name)
+        return obj is not None and getattr(obj, "Visibility", True)
+
+    def handle_query_region(self, doc_name=None, region_min=None, region_max=None, contained=False, visible_only=False):
+        """返回包围盒与区域相交（contained 时完全位于区域内）的对象"""
+        try:
+            if not region_min or not region_max or len(region_min) != 3 or len(region_max) != 3:
+                return {"result": "error", "message": "min 和 max 必须是 [x, y, z]"}
+            doc = self._spatial_document(doc_name)
+            index = self._spatial_index(doc)
+            names = index.query(tuple(region_min) + tuple(region_max), contained)
+            if visible_only:
+                names = [name for name in names if self._visible(doc, name)]
+            return {
+                "result": "success",
+                "doc_name": doc.Name,
+                "objects": [{"name": name, "bound_box": list(index.boxes[name])} for name in sorted(names)],
+                "indexed_count": len(index)
+            }
+        except Exception as e:
+            log_error(f"区域查询错误: {str(e)}")
+            return {"result": "error", "message": str(e), "traceback": traceback.format_exc()}
+
+    def handle_nearest_objects(self, doc_name=None, point=None, k=5, max_distance=None, visible_only=False):
+        """返回包围盒离点最近的 k 个对象，距离为点到包围盒的距离（点在盒内时为 0）"""
+        try:
+            if not point or len(point) != 3:
+                return {"result": "error", "message": "point 必须是 [x, y, z]"}
+            doc = self._spatial_document(doc_name)
+            index = self._spatial_index(doc)
+            objects = []
+            # 过滤不可见对象时多取一些，不够再扩大
+            want = int(k)
+            while True:
+                found = index.nearest(tuple(point), want, max_distance)
+                objects = [(d, name) for d, name in found if not visible_only or self._visible(doc, name)]
+                if len(objects) >= k or len(found) < want:
+                    break
+                want *= 2
+            return {
+                "result": "success",
+                "doc_name": doc.Name,
+                "objects": [{"name": name, "distance": d} for d, name in objects[:int(k)]]
+            }
+        except Exception as e:
+            log_error(f"最近对象查询错误: {str(e)}")
+            return {"result": "error", "message": str(e), "traceback": traceback.format_exc()}
+
+    def handle_collision_candidates(self, doc_name=None, object_names=None, tolerance=0.0, visible_only=True,
+                                    max_pairs=1000):
+        """
+        返回包围盒相交（间距不超过 tolerance）的对象对，作为碰撞检测的粗筛结果
+
+        object_names 指定时只检查涉及这些对象的对；默认忽略不可见对象，
+        避免 Body 与其内部特征等重叠的中间对象产生大量无意义的对。
+        """
+        try:
+            doc = self._spatial_document(doc_name)
+            index = self._spatial_index(doc)
+            pairs = index.overlapping_pairs(object_names, float(tolerance))
+            if visible_only:
+                visible = {}
+                def is_visible(name):
+                    if name not in visible:
+                        visible[name] = self._visible(doc, name)
+                    return visible[name]
+                pairs = [pair for pair in pairs if is_visible(pair[0]) and is_visible(pair[1])]
+            return {
+                "result": "success",
+                "doc_name": doc.Name,
+                "pairs": [list(pair) for pair in pairs[:max_pairs]],
+                "total_pairs": len(pairs),
+                "truncated": len(pairs) > max_pairs
+            }
+        except Exception as e:
+            log_error(f"碰撞候选查询错误: {str(e)}")
+            return {"result": "error", "message": str(e), "traceback": traceback.format_exc()}
+
+    def handle_validate_macro_code(self, macro_name=None, code=None, profile=None):
+        profiled = None
         try:
             if not code:
                 if not macro_name or not os.path.exists(os.path.join(App.getUserMacroDir(), f"{macro_name}.FCMacro")):
@@ -403,14 +2023,19 @@ class FreeCADMCPServer:
                     return {"result": "error", "message": "宏文件名无效或文件不存在"}
                 with open(os.path.join(App.getUserMacroDir(), f"{macro_name}.FCMacro"), 'r', encoding='utf-8') as f:
                     code = f.read()
-            temp_doc = App.newDocument("TempValidateDoc")
-            exec(code, {"App": App, "Gui": Gui})
-            App.closeDocument("TempValidateDoc")
+            with self._scratch_document():
+                with self._profiling(profile, macro_name or "validate") as profiled:
+                    exec(code, {"App": App, "Gui": Gui, "progress": self.report_progress})
             log_message("宏代码验证成功")
-            return {"result": "success", "message": "宏代码验证成功"}
+            return self._with_profile({"result": "success", "message": "宏代码验证成功"}, profiled)
+        except JobCancelled as e:
+            log_message(f"宏代码验证已取消: {str(e)}")
+            return self._with_profile({"result": "error", "message": str(e), "cancelled": True}, profiled)
+        except StreamClosed as e:
+            return self._with_profile({"result": "error", "message": str(e)}, profiled)
         except Exception as e:
             log_error(f"验证宏代码错误: {str(e)}")
-            return {"result": "error", "message": str(e), "traceback": traceback.format_exc()}
+            return self._with_profile({"result": "error", "message": str(e), "traceback": traceback.format_exc()}, profiled)
 
     def handle_set_view(self, view_type):
         try:
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+FreeCAD MCP 空间索引
+
+纯 Python 模块（不依赖 FreeCAD）。对象以轴对齐包围盒 (xmin, ymin, zmin, xmax, ymax, zmax)
+登记，静态部分用 STR (Sort-Tile-Recursive) 批量构建的 R 树保存；之后的插入、更新和
+删除先记录在增量区中，查询时与树合并，增量区过大时整体重建。
+"""
+
+import heapq
+import math
+
+
+def boxes_intersect(a, b):
+    return (a[0] <= b[3] and b[0] <= a[3] and
+            a[1] <= b[4] and b[1] <= a[4] and
+            a[2] <= b[5] and b[2] <= a[5])
+
+
+def box_contains(outer, inner):
+    return (outer[0] <= inner[0] and outer[1] <= inner[1] and outer[2] <= inner[2] and
+            inner[3] <= outer[3] and inner[4] <= outer[4] and inner[5] <= outer[5])
+
+
+def expand_box(box, margin):
+    return (box[0] - margin, box[1] - margin, box[2] - margin,
+            box[3] + margin, box[4] + margin, box[5] + margin)
+
+
+def point_box_distance(point, box):
+    """点到包围盒的欧氏距离，点在盒内时为 0"""
+    total = 0.0
+    for axis in range(3):
+        if point[axis] < box[axis]:
+            d = box[axis] - point[axis]
+        elif point[axis] > box[axis + 3]:
+            d = point[axis] - box[axis + 3]
+        else:
+            continue
+        total += d * d
+    return math.sqrt(total)
+
+
+def _union(boxes):
+    return (min(b[0] for b in boxes), min(b[1] for b in boxes), min(b[2] for b in boxes),
+            max(b[3] for b in boxes), max(b[4] for b in boxes), max(b[5] for b in boxes))
+
+
+def _center(box, axis):
+    return box[axis] + box[axis + 3]
+
+
+class _Node:
+    __slots__ = ("box", "children", "leaf")
+
+    def __init__(self, box, children, leaf):
+        self.box = box
+        self.children = children  # 叶节点为 [(box, key)]，内部节点为 [_Node]
+        self.leaf = leaf
+
+
+class SpatialIndex:
+    """
+    包围盒 R 树
+
+    node_capacity 为每个节点的最大子项数。增量区的条目数超过
+    max(min_rebuild, rebuild_ratio * 条目总数) 时重建树。
+    """
+
+    def __init__(self, node_capacity=16, rebuild_ratio=0.1, min_rebuild=256):
+        self.node_capacity = node_capacity
+        self.rebuild_ratio = rebuild_ratio
+        self.min_rebuild = min_rebuild
+        self.boxes = {}  # key -> 当前包围盒
+        self.root = None
+        self.overlay = {}  # 树构建后插入或更新的 key -> 包围盒
+        self.stale = set()  # 树中已删除或已更新（位置作废）的 key
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def __contains__(self, key):
+        return key in self.boxes
+
+    def bulk_load(self, items):
+        """用 (key, box) 序列重建整个索引"""
+        self.boxes = dict(items)
+        self._rebuild()
+
+    def insert(self, key, box):
+        """插入或更新条目"""
+        if key in self.boxes and key not in self.overlay:
+            self.stale.add(key)
+        self.boxes[key] = box
+        self.overlay[key] = box
+        self._maybe_rebuild()
+
+    def remove(self, key):
+        if self.boxes.pop(key, None) is None:
+            return
+        if self.overlay.pop(key, None) is None or key in self.stale:
+            self.stale.add(key)
+        self._maybe_rebuild()
+
+    def rebuild_threshold(self):
+        """增量区超过该条目数时重建；一次更新更多条目时应直接 bulk_load"""
+        return max(self.min_rebuild, self.rebuild_ratio * len(self.boxes))
+
+    def _maybe_rebuild(self):
+        if len(self.overlay) + len(self.stale) > self.rebuild_threshold():
+            self._rebuild()
+
+    def _rebuild(self):
+        self.overlay = {}
+        self.stale = set()
+        entries = [(box, key) for key, box in self.boxes.items()]
+        if not entries:
+            self.root = None
+            return
+        nodes = self._pack(entries, leaf=True)
+        while len(nodes) > 1:
+            nodes = self._pack([(node.box, node) for node in nodes], leaf=False)
+        self.root = nodes[0]
+
+    def _pack(self, entries, leaf):
+        """STR：依次按 x、y、z 中心排序切片，每组 node_capacity 个子项组成一个节点"""
+        capacity = self.node_capacity
+        node_count = math.ceil(len(entries) / capacity)
+        slices = max(1, round(node_count ** (1 / 3)))
+        groups = [entries]
+        for axis in range(3):
+            per_group = capacity * slices ** (2 - axis)
+            next_groups = []
+            for group in groups:
+                group.sort(key=lambda e: _center(e[0], axis))
+                next_groups.extend(group[i:i + per_group] for i in range(0, len(group), per_group))
+            groups = next_groups
+        nodes = []
+        for group in groups:
+            for i in range(0, len(group), capacity):
+                chunk = group[i:i + capacity]
+                children = chunk if leaf else [child for _, child in chunk]
+                nodes.append(_Node(_union([box for box, _ in chunk]), children, leaf))
+        return nodes
+
+    def _tree_entries(self, box_test):
+        """遍历树中包围盒通过 box_test 的有效条目"""
+        if self.root is None or not box_test(self.root.box):
+            return
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node.leaf:
+                for box, key in node.children:
+                    if key not in self.stale and box_test(box):
+                        yield key, box
+            else:
+                stack.extend(child for child in node.children if box_test(child.box))
+
+    def query(self, region, contained=False):
+        """返回与 region 相交（contained 为 True 时完全位于 region 内）的 key 列表"""
+        result = [key for key, _ in self._tree_entries(lambda box: boxes_intersect(box, region))]
+        result.extend(key for key, box in self.overlay.items() if boxes_intersect(box, region))
+        if contained:
+            result = [key for key in result if box_contains(region, self.boxes[key])]
+        return result
+
+    def nearest(self, point, k=1, max_distance=None):
+        """返回离点最近的 k 个条目 [(距离, key)]，距离为点到包围盒的距离"""
+        limit = math.inf if max_distance is None else max_distance
+        # 增量区条目直接参与排序
+        heap = [(point_box_distance(point, box), 1, key, None) for key, box in self.overlay.items()]
+        if self.root is not None:
+            heap.append((point_box_distance(point, self.root.box), 0, None, self.root))
+        heapq.heapify(heap)
+        result = []
+        counter = 2  # 距离相同时避免比较节点对象
+        while heap and len(result) < k:
+            distance, _, key, node = heapq.heappop(heap)
+            if distance > limit:
+                break
+            if node is None:
+                result.append((distance, key))
+            elif node.leaf:
+                for box, child_key in node.children:
+                    if child_key not in self.stale:
+                        heapq.heappush(heap, (point_box_distance(point, box), counter, child_key, None))
+                        counter += 1
+            else:
+                for child in node.children:
+                    heapq.heappush(heap, (point_box_distance(point, child.box), counter, None, child))
+                    counter += 1
+        return result
+
+    def overlapping_pairs(self, keys=None, tolerance=0.0):
+        """
+        包围盒相交（间距不超过 tolerance）的条目对，用作碰撞检测的粗筛
+
+        keys 指定时只返回至少包含其中一个条目的对，每对按 (较小 key, 较大 key) 去重。
+        """
+        sources = self.boxes if keys is None else {key: self.boxes[key] for key in keys if key in self.boxes}
+        pairs = set()
+        for key, box in sources.items():
+            for other in self.query(expand_box(box, tolerance)):
+                if other != key:
+                    pairs.add((key, other) if key < other else (other, key))
+        return sorted(pairs)
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+FreeCAD MCP 命令轨迹记录
+
+纯 Python 模块（不依赖 FreeCAD）。服务器开启记录后，每条客户端命令以一条记录
+追加写入轨迹文件，记录格式复用 freecad_mcp_protocol 的二进制帧（超过阈值时压缩）:
+
+    {"t": 收到命令的时间戳, "wait": 开始执行前的排队时间(秒), "dt": 执行耗时(秒),
+     "conn": 连接序号, "request": 命令, "response": 响应（延迟响应时为 None）}
+
+src/freecad_mcp_replay.py 读取轨迹并按原始或加速的节奏重放。
+"""
+
+import freecad_mcp_protocol as protocol
+
+TRACE_COMPRESS_THRESHOLD = 256
+
+
+class TraceRecorder:
+    """只追加的轨迹写入器，每条记录写入后立即刷新，进程异常退出时最多丢失一条"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "ab")
+        self.count = 0
+
+    def record(self, conn, received_at, wait, duration, request, response):
+        entry = {"t": received_at, "wait": wait, "dt": duration, "conn": conn, "request": request, "response": response}
+        self.file.write(protocol.encode_frame(entry, "json", TRACE_COMPRESS_THRESHOLD))
+        self.file.flush()
+        self.count += 1
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+def read_trace(path):
+    """按写入顺序逐条读取轨迹记录，忽略文件末尾写了一半的记录"""
+    with open(path, "rb") as f:
+        data = memoryview(f.read())
+    offset = 0
+    while offset < len(data):
+        entry, consumed = protocol.decode_frame(data[offset:])
+        if entry is None:
+            break
+        yield entry
+        offset += consumed
@@ -4,16 +4,20 @@ FreeCAD MCP客户端 - 绝对路径优化版本
 确保100%的路径解析成功率
 """
 
-from typing import Any, Dict
+from typing import Any, Dict, List
 import socket
 import json
 import asyncio
 import re
 import sys
 import ast
+import builtins
 import os
 import argparse
 import traceback
+import threading
+import time
+import uuid
 from pydantic import BaseModel
 
 try:
@@ -25,10 +29,21 @@ except ImportError as e:
 mod_dir = os.path.join(os.path.expanduser("~"), "FreeCAD", "Mod", "freecad_mcp")
 if mod_dir not in sys.path:
     sys.path.append(mod_dir)
+# 源码目录布局下，协议模块位于仓库根目录
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if repo_dir not in sys.path:
+    sys.path.append(repo_dir)
+
+import freecad_mcp_protocol as protocol
 
 mcp = FastMCP("freecad-bridge-absolute")
 FREECAD_HOST = 'localhost'
 FREECAD_PORT = 9876
+FREECAD_SOCKET = None  # Unix 域套接字路径，设置后优先于 TCP
+FREECAD_BINARY = True  # 是否与服务器协商二进制帧和压缩
+ROUTER = None  # 配置了多个服务器(--servers)时的路由器
+CLIENT_ID = uuid.uuid4().hex  # 本客户端进程的标识，服务器据此公平调度并限制取消权限
+PROTOCOL_CACHE = {}  # 服务器地址 -> 协商的帧参数（None 表示使用JSON文本），每个服务器只握手一次
 
 def get_absolute_macro_path(macro_name: str) -> str:
     """
@@ -46,54 +61,580 @@ def get_absolute_macro_path(macro_name: str) -> str:
     absolute_path = os.path.join(macro_dir, macro_name)
     return absolute_path
 
-def normalize_macro_code(code: str) -> str:
-    """标准化宏代码"""
+# 宏中可直接使用的名称 -> 缺失时注入的导入语句
+KNOWN_IMPORTS = {
+    "App": "import FreeCAD as App",
+    "FreeCAD": "import FreeCAD",
+    "Gui": "import FreeCADGui as Gui",
+    "FreeCADGui": "import FreeCADGui",
+    "Part": "import Part",
+    "Draft": "import Draft",
+    "Sketcher": "import Sketcher",
+    "Mesh": "import Mesh",
+    "Base": "from FreeCAD import Base",
+    "Vector": "from FreeCAD import Vector",
+    "math": "import math",
+}
+# 服务器执行宏时注入的全局名称
+SERVER_GLOBALS = {"progress", "__file__", "__name__"}
+
+def _bound_names(tree: ast.AST) -> set:
+    """收集模块中任意位置绑定的名称（不区分作用域，只用于发现明显未定义的名称）"""
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, (ast.Store, ast.Del)):
+            names.add(node.id)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(node.name)
+        elif isinstance(node, ast.arg):
+            names.add(node.arg)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                names.add(alias.asname or alias.name.split('.')[0])
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            names.add(node.name)
+        elif isinstance(node, (ast.Global, ast.Nonlocal)):
+            names.update(node.names)
+        elif isinstance(node, ast.MatchAs) and node.name:
+            names.add(node.name)
+        elif isinstance(node, ast.MatchStar) and node.name:
+            names.add(node.name)
+        elif isinstance(node, ast.MatchMapping) and node.rest:
+            names.add(node.rest)
+    return names
+
+def _import_insert_line(tree: ast.Module) -> int:
+    """注入导入的位置：模块文档字符串和 __future__ 导入之后"""
+    line = 0
+    for index, node in enumerate(tree.body):
+        is_docstring = index == 0 and isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant) \
+            and isinstance(node.value.value, str)
+        is_future = isinstance(node, ast.ImportFrom) and node.module == "__future__"
+        if not (is_docstring or is_future):
+            break
+        line = node.end_lineno
+    return line
+
+def preprocess_macro_code(code: str) -> Dict[str, Any]:
+    """
+    基于AST在本地预处理宏代码
+    
+    检查语法错误和明显未定义的名称，按实际使用注入缺失的导入，并计算内容哈希。
+    返回 code、hash、injected_imports、undefined_names，语法错误时返回 syntax_error。
+    """
     code = code.strip()
     if not code:
-        return "# FreeCAD Macro\n"
+        code = "# FreeCAD Macro"
+    try:
+        tree = ast.parse(code)
+    except SyntaxError as e:
+        return {
+            "code": code,
+            "syntax_error": {"message": e.msg, "line": e.lineno, "offset": e.offset, "text": (e.text or "").rstrip()}
+        }
+    
+    bound = _bound_names(tree)
+    used = {node.id for node in ast.walk(tree) if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load)}
+    missing = sorted(name for name in used - bound if name in KNOWN_IMPORTS)
+    injected = [KNOWN_IMPORTS[name] for name in missing]
+    
+    # 存在 from x import * 时无法判断名称来源，跳过未定义检查
+    has_star_import = any(isinstance(node, ast.ImportFrom) and any(a.name == "*" for a in node.names)
+                          for node in ast.walk(tree))
+    undefined = []
+    if not has_star_import:
+        known = bound | set(KNOWN_IMPORTS) | SERVER_GLOBALS | set(dir(builtins))
+        undefined = sorted(used - known)
+    
     lines = code.splitlines()
-    has_freecad = any("import FreeCAD" in line for line in lines)
-    has_gui = any("import FreeCADGui" in line for line in lines)
-    has_part = any("import Part" in line for line in lines)
-    has_math = any("import math" in line for line in lines)
-    
-    result_lines = []
-    if not has_freecad:
-        result_lines.append("import FreeCAD as App")
-    if not has_gui:
-        result_lines.append("import FreeCADGui as Gui")
-    if not has_part:
-        result_lines.append("import Part")
-    if not has_math:
-        result_lines.append("import math")
-    if result_lines:
-        result_lines.append("")
-    
-    result_lines.extend(lines)
-    return "\n".join(result_lines)
-
-async def send_command_to_freecad(command: Dict[str, Any]) -> Dict[str, Any]:
-    """发送命令到FreeCAD服务器"""
+    if injected:
+        insert_at = _import_insert_line(tree)
+        lines[insert_at:insert_at] = injected + [""]
+    normalized = "\n".join(lines) + "\n"
+    return {
+        "code": normalized,
+        "hash": protocol.content_hash(normalized),
+        "injected_imports": injected,
+        "undefined_names": undefined
+    }
+
+def normalize_macro_code(code: str) -> str:
+    """标准化宏代码（注入缺失的导入）"""
+    return preprocess_macro_code(code)["code"]
+
+def precheck_error(pre: Dict[str, Any], allow_undefined_names: bool = False):
+    """本地预检失败时返回错误响应，免去一次到FreeCAD的往返"""
+    if "syntax_error" in pre:
+        err = pre["syntax_error"]
+        return {"result": "error", "message": f"语法错误 (第 {err['line']} 行): {err['message']}", "syntax_error": err}
+    if pre["undefined_names"] and not allow_undefined_names:
+        return {
+            "result": "error",
+            "message": f"未定义的名称: {', '.join(pre['undefined_names'])}",
+            "undefined_names": pre["undefined_names"]
+        }
+    return None
+
+def resolve_target(target=None):
+    """target 为 ("unix", 路径) 或 ("tcp", (主机, 端口))，默认使用命令行配置"""
+    if target is None:
+        target = ("unix", FREECAD_SOCKET) if FREECAD_SOCKET else ("tcp", (FREECAD_HOST, FREECAD_PORT))
+    return target
+
+async def open_freecad_connection(target=None):
+    """打开到FreeCAD服务器的连接"""
+    target = resolve_target(target)
+    if target[0] == "unix":
+        return await asyncio.open_unix_connection(target[1])
+    return await asyncio.open_connection(*target[1])
+
+async def read_json_text(reader) -> Dict[str, Any]:
+    """读取一条完整的JSON文本消息"""
+    data = b''
+    while True:
+        chunk = await reader.read(65536)
+        if not chunk:
+            raise ConnectionError("服务器在响应完成前关闭了连接")
+        data += chunk
+        try:
+            return protocol.from_json_compatible(json.loads(data.decode('utf-8')))
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            # 数据可能不完整，继续读取
+            continue
+
+async def read_frame(reader) -> Dict[str, Any]:
+    """读取一条二进制帧消息"""
+    header = await reader.readexactly(protocol.HEADER.size)
+    flags, encoding, count, payload_length = protocol.parse_header(header)
+    table = await reader.readexactly(protocol.table_size(count))
+    payload = await reader.readexactly(payload_length)
+    return protocol.decode_payload(flags, encoding, table, payload)
+
+async def negotiate_protocol(reader, writer):
+    """发送hello握手，返回协商的帧参数；服务器不支持时返回None，继续使用JSON文本"""
+    hello = {
+        "type": "hello",
+        "params": {
+            "encodings": protocol.supported_encodings(),
+            "compression": protocol.supported_compression(),
+            "stream": True
+        }
+    }
+    writer.write(protocol.encode_json_text(hello))
+    await writer.drain()
+    response = await read_json_text(reader)
+    if response.get("result") != "success":
+        return None
+    return {
+        "encoding": response["encoding"],
+        "compress_threshold": response["compress_threshold"] if response.get("compression") else None
+    }
+
+async def send_message(writer, settings, message: Dict[str, Any]):
+    if settings:
+        writer.write(protocol.encode_frame(message, settings["encoding"], settings["compress_threshold"]))
+    else:
+        writer.write(protocol.encode_json_text(message))
+    await writer.drain()
+
+async def read_message(reader, settings) -> Dict[str, Any]:
+    if settings:
+        return await read_frame(reader)
+    return await read_json_text(reader)
+
+async def send_command_to_target(target, command: Dict[str, Any], on_stream=None,
+                                 idle_timeout: float = None) -> Dict[str, Any]:
+    """
+    发送命令到指定服务器并返回响应，连接失败时抛出异常
+
+    最终响应之前的增量输出帧（type 为 stream）交给 on_stream 处理；on_stream 返回
+    非空字符串时关闭连接以中止服务器上的执行，并以该字符串作为错误信息返回。
+    idle_timeout 为两条消息之间的最长等待时间。
+    """
+    target = resolve_target(target)
+    reader, writer = await open_freecad_connection(target)
+    cached = FREECAD_BINARY and target in PROTOCOL_CACHE
     try:
-        reader, writer = await asyncio.open_connection(FREECAD_HOST, FREECAD_PORT)
-        
-        # 发送命令
-        command_json = json.dumps(command, ensure_ascii=False)
-        writer.write(command_json.encode('utf-8'))
-        await writer.drain()
-        
-        # 接收响应
-        response_data = await reader.read(8192)
-        response = json.loads(response_data.decode('utf-8'))
-        
+        if cached:
+            # 服务器根据帧魔数识别，无需每个连接重新握手
+            settings = PROTOCOL_CACHE[target]
+        elif FREECAD_BINARY:
+            settings = await negotiate_protocol(reader, writer)
+            PROTOCOL_CACHE[target] = settings
+        else:
+            settings = None
+        # 发送命令并接收响应
+        await send_message(writer, settings, command)
+        while True:
+            message = await asyncio.wait_for(read_message(reader, settings), idle_timeout)
+            if message.get("type") != "stream" or "result" in message:
+                return message
+            reason = on_stream(message) if on_stream else None
+            if reason:
+                return {"result": "error", "message": reason, "aborted": True}
+    except (OSError, ConnectionError, asyncio.IncompleteReadError, protocol.ProtocolError) as e:
+        # 服务器可能已重启或更换，缓存的协商结果不再可信，下次重新握手
+        if cached and not isinstance(e, asyncio.TimeoutError):
+            PROTOCOL_CACHE.pop(target, None)
+        raise
+    finally:
         writer.close()
         await writer.wait_closed()
-        
-        return response
-        
+
+async def send_command_to_freecad(command: Dict[str, Any], on_stream=None, idle_timeout: float = None) -> Dict[str, Any]:
+    """发送命令到FreeCAD服务器；配置了多个服务器时由路由器选择实例"""
+    # 每条请求带上 ID，排队期间可以通过 list_requests / cancel_request 取消；
+    # 每条命令使用新连接，client_id 让服务器把同一进程的请求归到一个队列
+    command.setdefault("id", uuid.uuid4().hex[:12])
+    command.setdefault("client_id", CLIENT_ID)
+    try:
+        if ROUTER:
+            return await ROUTER.send(command, on_stream=on_stream, idle_timeout=idle_timeout)
+        return await send_command_to_target(None, command, on_stream, idle_timeout)
+    except asyncio.TimeoutError:
+        return {"result": "error", "message": f"等待FreeCAD服务器响应超时 ({idle_timeout}s 内没有输出)"}
     except Exception as e:
         return {"result": "error", "message": f"连接FreeCAD服务器失败: {str(e)}"}
 
+def parse_server_spec(spec: str):
+    """解析 host:port 或 unix:/path 形式的服务器地址"""
+    spec = spec.strip()
+    if spec.startswith("unix:"):
+        return ("unix", spec[len("unix:"):])
+    host, _, port = spec.rpartition(":")
+    if not host or not port.isdigit():
+        raise ValueError(f"无效的服务器地址: {spec}（应为 host:port 或 unix:/path）")
+    return ("tcp", (host.strip("[]"), int(port)))
+
+def _macro_document_name(macro_path: str, params: Dict[str, Any]) -> str:
+    """与服务器 _get_document_name 相同的规则，推算 run_macro 使用的文档名称"""
+    doc_name = (params or {}).get("doc_name") or os.path.splitext(os.path.basename(macro_path or ""))[0]
+    doc_name = re.sub(r'[^\w\-]', '_', doc_name)
+    if not doc_name or doc_name.isdigit():
+        doc_name = f"Document_{doc_name}"
+    return doc_name
+
+class Backend:
+    """一个FreeCAD服务器实例及其健康状态"""
+
+    def __init__(self, target):
+        self.target = target
+        self.name = f"unix:{target[1]}" if target[0] == "unix" else f"{target[1][0]}:{target[1][1]}"
+        self.healthy = True  # 首次健康检查前假定可用
+        self.busy = False  # ping 超时：服务器在主线程执行长时间任务，仍然存活
+        self.inflight = 0  # 本客户端发往该实例且未完成的请求数
+        self.server_load = 0  # 最近一次 ping 报告的排队命令和任务数
+        self.last_error = None
+
+    @property
+    def load(self):
+        return self.inflight + self.server_load
+
+class ServerRouter:
+    """
+    在多个FreeCAD服务器之间路由命令
+
+    - 宏文件命令（create/update/patch_macro）发送到所有健康实例，保证任意实例都能运行该宏；
+      get_macro_hash 同样发往所有实例，只有各实例哈希一致时才返回该哈希
+    - 无状态命令（验证、试运行）发往负载最低的实例，失败时换下一个
+    - 文档相关命令固定发往创建该文档的实例；实例失效时改派到其他实例，响应中标明 failover
+    - 任务命令发往提交该任务的实例；list_documents 汇总所有实例
+    """
+
+    BROADCAST_COMMANDS = {"create_macro", "update_macro", "patch_macro"}
+    STATELESS_COMMANDS = {"validate_macro_code", "ping"}
+    BUSY_LOAD = 1000  # ping 超时的实例计入的负载，使无状态命令优先发往空闲实例
+    JOB_COMMANDS = {"job_status", "wait_job", "cancel_job"}
+
+    def __init__(self, targets, health_interval=5.0, health_timeout=2.0):
+        self.backends = [Backend(target) for target in targets]
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.last_health_check = 0.0
+        self.doc_owner = {}  # 文档名称 -> Backend
+        self.job_owner = {}  # 任务 ID -> Backend
+        self.active = None  # 最近执行文档命令的实例，未指定文档的命令发往这里
+        self.lock = threading.Lock()
+
+    async def _ping(self, backend):
+        try:
+            response = await asyncio.wait_for(send_command_to_target(backend.target, {"type": "ping"}),
+                                              self.health_timeout)
+            load = response.get("load") or {}
+            with self.lock:
+                backend.healthy = response.get("result") == "success"
+                backend.busy = False
+                backend.server_load = load.get("queued", 0) + load.get("jobs", 0)
+                backend.last_error = None if backend.healthy else response.get("message")
+        except asyncio.TimeoutError:
+            # FreeCAD 在 GUI 线程上服务套接字，执行长宏或任务时 ping 会超时；
+            # 这不代表实例失效，只提高负载，文档仍固定在该实例上
+            with self.lock:
+                backend.busy = True
+                backend.server_load = max(backend.server_load, self.BUSY_LOAD)
+                backend.last_error = f"ping 超过 {self.health_timeout}s 未响应（实例忙）"
+        except Exception as e:
+            with self.lock:
+                backend.healthy = False
+                backend.last_error = str(e) or type(e).__name__
+
+    async def check_health(self, force=False):
+        """距上次检查超过 health_interval 时 ping 所有实例（包括已失效的，以便恢复后重新启用）"""
+        now = time.monotonic()
+        with self.lock:
+            if not force and now - self.last_health_check < self.health_interval:
+                return
+            self.last_health_check = now
+        await asyncio.gather(*(self._ping(backend) for backend in self.backends))
+
+    def _healthy(self, exclude=()):
+        return [b for b in self.backends if b.healthy and b not in exclude]
+
+    def _least_loaded(self, exclude=()):
+        candidates = self._healthy(exclude)
+        return min(candidates, key=lambda b: b.load) if candidates else None
+
+    async def _send_to(self, backend, command, **options):
+        with self.lock:
+            backend.inflight += 1
+        try:
+            return await send_command_to_target(backend.target, command, **options)
+        except asyncio.TimeoutError:
+            # 响应超时说明实例忙，不是失效（TimeoutError 也是 OSError 的子类，需先处理）
+            raise
+        except (OSError, ConnectionError, asyncio.IncompleteReadError, protocol.ProtocolError) as e:
+            with self.lock:
+                backend.healthy = False
+                backend.last_error = str(e) or type(e).__name__
+            raise
+        finally:
+            with self.lock:
+                backend.inflight -= 1
+
+    async def _send_with_failover(self, command, first=None, **options):
+        """依次尝试实例直到连接成功，返回 (backend, response)"""
+        tried = []
+        backend = first if first and first.healthy else self._least_loaded()
+        while backend is not None:
+            try:
+                return backend, await self._send_to(backend, command, **options)
+            except asyncio.TimeoutError:
+                raise
+            except (OSError, ConnectionError, asyncio.IncompleteReadError, protocol.ProtocolError):
+                tried.append(backend)
+                backend = self._least_loaded(exclude=tried)
+        errors = "; ".join(f"{b.name}: {b.last_error}" for b in self.backends)
+        raise ConnectionError(f"没有可用的FreeCAD服务器 ({errors})")
+
+    def _document_key(self, command):
+        command_type = command.get("type")
+        params = command.get("params") or {}
+        if command_type == "submit_job":
+            return self._document_key(params.get("command") or {})
+        if command_type == "run_macro":
+            macro_params = params.get("params") or {}
+            if macro_params.get("dry_run"):
+                return None
+            return _macro_document_name(params.get("macro_path"), macro_params)
+        return params.get("doc_name")
+
+    def _is_stateless(self, command):
+        command_type = command.get("type")
+        if command_type == "submit_job":
+            return self._is_stateless((command.get("params") or {}).get("command") or {})
+        if command_type == "run_macro":
+            return bool(((command.get("params") or {}).get("params") or {}).get("dry_run"))
+        return command_type in self.STATELESS_COMMANDS
+
+    async def send(self, command, **options):
+        """按命令类型选择实例发送；options 传给 send_command_to_target（on_stream、idle_timeout）"""
+        await self.check_health()
+        command_type = command.get("type")
+        if command_type in self.BROADCAST_COMMANDS:
+            return await self._broadcast(command)
+        if command_type == "get_macro_hash":
+            return await self._macro_hash(command)
+        if command_type == "list_documents":
+            return await self._merge_lists(command, "documents")
+        if command_type == "list_requests":
+            return await self._merge_lists(command, "requests")
+        if command_type == "cancel_request":
+            return await self._cancel_request(command)
+        if command_type in self.JOB_COMMANDS:
+            return await self._send_job_command(command, **options)
+        if self._is_stateless(command):
+            backend, response = await self._send_with_failover(command, **options)
+        else:
+            backend, response = await self._send_document_command(command, **options)
+        if command_type == "submit_job" and response.get("job_id"):
+            with self.lock:
+                self.job_owner[response["job_id"]] = backend
+        response["server"] = backend.name
+        return response
+
+    async def _send_document_command(self, command, **options):
+        doc_name = self._document_key(command)
+        with self.lock:
+            owner = self.doc_owner.get(doc_name) if doc_name else self.active
+        backend, response = await self._send_with_failover(command, first=owner, **options)
+        with self.lock:
+            if doc_name and (owner is None or owner is not backend):
+                self.doc_owner[doc_name] = backend
+            self.active = backend
+        if owner is not None and owner is not backend:
+            # 文档只存在于原实例的内存中，新实例上需要重新构建
+            response["failover"] = {"from": owner.name, "to": backend.name, "document_lost": bool(doc_name)}
+        return backend, response
+
+    async def _send_job_command(self, command, **options):
+        job_id = (command.get("params") or {}).get("job_id")
+        with self.lock:
+            backend = self.job_owner.get(job_id)
+        if backend is None:
+            return {"result": "error", "message": f"任务不存在或不是由本客户端提交: {job_id}"}
+        try:
+            response = await self._send_to(backend, command, **options)
+        except asyncio.TimeoutError:
+            raise
+        except (OSError, ConnectionError, asyncio.IncompleteReadError, protocol.ProtocolError) as e:
+            return {"result": "error", "message": f"任务所在的服务器 {backend.name} 不可用: {e}", "server": backend.name}
+        response["server"] = backend.name
+        return response
+
+    async def _broadcast(self, command):
+        backends = self._healthy()
+        if not backends:
+            raise ConnectionError("没有可用的FreeCAD服务器")
+        results = await asyncio.gather(*(self._send_to(b, command) for b in backends), return_exceptions=True)
+        failed = {}
+        response = None
+        for backend, result in zip(backends, results):
+            if isinstance(result, BaseException):
+                failed[backend.name] = str(result) or type(result).__name__
+            elif result.get("result") != "success":
+                failed[backend.name] = result.get("message")
+                response = response or result
+            elif response is None or response.get("result") != "success":
+                response = result
+        if response is None:
+            raise ConnectionError(f"所有服务器均失败: {failed}")
+        response["servers"] = [b.name for b in backends if b.name not in failed]
+        if failed:
+            response["failed_servers"] = failed
+        return response
+
+    async def _macro_hash(self, command):
+        """
+        查询所有健康实例上的宏哈希
+
+        曾经失效的实例或使用独立宏目录的实例可能持有旧版本，只有全部实例一致时
+        才返回该哈希；否则 hash 为 None，update_macro 会重新上传到所有实例。
+        """
+        backends = self._healthy()
+        if not backends:
+            raise ConnectionError("没有可用的FreeCAD服务器")
+        results = await asyncio.gather(*(self._send_to(b, command) for b in backends), return_exceptions=True)
+        hashes = {}
+        for backend, result in zip(backends, results):
+            if isinstance(result, BaseException) or result.get("result") != "success":
+                hashes[backend.name] = None
+            else:
+                hashes[backend.name] = result.get("hash")
+        values = set(hashes.values())
+        agreed = values.pop() if len(values) == 1 else None
+        return {"result": "success", "exists": any(h is not None for h in hashes.values()), "hash": agreed,
+                "hashes": hashes}
+
+    async def _merge_lists(self, command, key):
+        """向所有实例发送查询，合并响应中 key 对应的列表，每项标明所在实例"""
+        backends = self._healthy()
+        results = await asyncio.gather(*(self._send_to(b, command) for b in backends), return_exceptions=True)
+        items = []
+        servers = []
+        for backend, result in zip(backends, results):
+            if isinstance(result, BaseException) or result.get("result") != "success":
+                continue
+            servers.append(backend.name)
+            for item in result.get(key, []):
+                item["server"] = backend.name
+                items.append(item)
+        return {"result": "success", key: items, "servers": servers}
+
+    async def _cancel_request(self, command):
+        """请求 ID 只会在一个实例上排队，逐个实例尝试取消"""
+        response = {"result": "error", "message": "没有可用的FreeCAD服务器", "cancelled": False}
+        for backend in self._healthy():
+            try:
+                response = await self._send_to(backend, command)
+            except (OSError, ConnectionError, asyncio.IncompleteReadError, protocol.ProtocolError):
+                continue
+            if response.get("cancelled"):
+                response["server"] = backend.name
+                break
+        return response
+
+    def status(self):
+        with self.lock:
+            return [{
+                "server": b.name,
+                "healthy": b.healthy,
+                "busy": b.busy,
+                "inflight": b.inflight,
+                "server_load": b.server_load,
+                "documents": sorted(name for name, owner in self.doc_owner.items() if owner is b),
+                "last_error": b.last_error
+            } for b in self.backends]
+
+def call_freecad_async(coro, timeout: float = 30):
+    """同步执行协程，兼容已有运行中事件循环的情况"""
+    try:
+        asyncio.get_running_loop()
+        # 如果有运行中的循环，使用线程池执行
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            future = executor.submit(asyncio.run, coro)
+            return future.result(timeout=timeout)
+    except RuntimeError:
+        # 没有运行中的循环，可以直接使用 asyncio.run
+        return asyncio.run(coro)
+
+def call_freecad(command: Dict[str, Any], timeout: float = 30) -> Dict[str, Any]:
+    """同步发送命令"""
+    return call_freecad_async(send_command_to_freecad(command), timeout)
+
+def call_freecad_streaming(command: Dict[str, Any], abort_pattern: str = None,
+                           idle_timeout: float = 30) -> Dict[str, Any]:
+    """
+    请求服务器在执行期间流式发送 stdout/stderr 和 progress()，边执行边输出到 stderr
+
+    超时只针对两次输出之间的间隔，持续输出的长时间构建不会因总时长超时；
+    输出匹配 abort_pattern 时断开连接，服务器在宏的下一次输出或 progress() 时终止执行。
+    """
+    command["params"]["stream"] = True
+    pattern = re.compile(abort_pattern) if abort_pattern else None
+    state = {"recent": "", "output": []}
+
+    def on_stream(frame):
+        if frame.get("stream") == "progress":
+            fraction = frame.get("fraction")
+            percent = f"{fraction * 100:.0f}% " if fraction is not None else ""
+            print(f"[进度] {percent}{frame.get('message', '')}", file=sys.stderr)
+            return None
+        data = frame.get("data", "")
+        state["output"].append(data)
+        sys.stderr.write(data)
+        sys.stderr.flush()
+        # 保留上一段结尾，跨帧的匹配也能发现
+        state["recent"] = (state["recent"] + data)[-8192:]
+        if pattern and pattern.search(state["recent"]):
+            return f"输出匹配 abort_pattern ({abort_pattern})，已中止宏执行"
+        return None
+
+    result = call_freecad_async(send_command_to_freecad(command, on_stream, idle_timeout), timeout=None)
+    if result.get("aborted"):
+        result["output"] = "".join(state["output"])[-65536:]
+    return result
+
 @mcp.tool()
 def create_macro(macro_name: str, template_type: str = "default") -> Dict[str, Any]:
     """
@@ -138,55 +679,99 @@ def create_macro(macro_name: str, template_type: str = "default") -> Dict[str, A
         return {"result": "error", "message": str(e), "traceback": traceback.format_exc()}
 
 @mcp.tool()
-def update_macro(macro_name: str, code: str) -> Dict[str, Any]:
+def update_macro(macro_name: str, code: str, allow_undefined_names: bool = False) -> Dict[str, Any]:
     """
     更新FreeCAD宏文件内容 - 绝对路径版本
     
+    代码先在本地做语法和未定义名称检查；服务器上已是相同内容时跳过上传。
+    
     Args:
         macro_name: 宏文件名称
         code: Python代码内容
+        allow_undefined_names: 为True时仅在结果中报告未定义名称，不阻止上传
     """
     try:
         # 获取绝对路径
         absolute_path = get_absolute_macro_path(macro_name)
         print(f"更新宏文件: {absolute_path}")
         
-        # 标准化代码
-        normalized_code = normalize_macro_code(code)
+        # 本地预处理：语法检查、导入注入、内容哈希
+        pre = preprocess_macro_code(code)
+        error = precheck_error(pre, allow_undefined_names)
+        if error:
+            return error
+        
+        current = call_freecad({"type": "get_macro_hash", "params": {"macro_name": macro_name}})
+        if current.get("result") == "success" and current.get("hash") == pre["hash"]:
+            return {
+                "result": "success",
+                "message": f"宏文件内容未变化，跳过上传: {macro_name}",
+                "hash": pre["hash"],
+                "unchanged": True
+            }
         
         command = {
             "type": "update_macro",
             "params": {
                 "macro_name": macro_name,
-                "code": normalized_code
+                "code": pre["code"]
             }
         }
-        
-        # 检查是否已有运行中的事件循环，避免冲突
-        try:
-            loop = asyncio.get_running_loop()
-            # 如果有运行中的循环，使用线程池执行
-            import concurrent.futures
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-                future = executor.submit(asyncio.run, send_command_to_freecad(command))
-                result = future.result(timeout=30)
-        except RuntimeError:
-            # 没有运行中的循环，可以直接使用 asyncio.run
-            result = asyncio.run(send_command_to_freecad(command))
-        
+        result = call_freecad(command)
+        if pre["injected_imports"]:
+            result["injected_imports"] = pre["injected_imports"]
+        if pre["undefined_names"]:
+            result["undefined_names"] = pre["undefined_names"]
         return result
         
     except Exception as e:
         return {"result": "error", "message": str(e), "traceback": traceback.format_exc()}
 
 @mcp.tool()
-def run_macro(macro_path: str, params: Dict[str, Any] = None) -> Dict[str, Any]:
+def patch_macro(macro_name: str, base_hash: str, edits: list = None, diff: str = None) -> Dict[str, Any]:
+    """
+    增量更新FreeCAD宏文件，无需重新发送完整源码
+    
+    Args:
+        macro_name: 宏文件名称
+        base_hash: 修改所基于的版本哈希（update_macro/patch_macro 返回的 hash）
+        edits: 行区间编辑列表，如 [{"start": 10, "end": 12, "text": "新代码"}]，行号从1开始、包含end
+        diff: 单文件 unified diff 文本（与 edits 二选一）
+    """
+    try:
+        command = {
+            "type": "patch_macro",
+            "params": {
+                "macro_name": macro_name,
+                "base_hash": base_hash,
+                "edits": edits,
+                "diff": diff
+            }
+        }
+        return call_freecad(command)
+        
+    except Exception as e:
+        return {"result": "error", "message": str(e), "traceback": traceback.format_exc()}
+
+@mcp.tool()
+def run_macro(macro_path: str, params: Dict[str, Any] = None, profile: bool = False,
+              profile_memory: bool = False, profile_top: int = 20, stream: bool = False,
+              abort_pattern: str = None, idle_timeout: float = 30) -> Dict[str, Any]:
     """
     运行FreeCAD宏 - 绝对路径版本
     
     Args:
         macro_path: 宏文件路径（将自动转换为绝对路径）
-        params: 可选参数
+        params: 可选参数，如 {"doc_name": "Gear", "checkpoint": "base"}；
+            运行在文档事务中，失败时原地回滚；成功且指定 checkpoint 时记录检查点
+            {"dry_run": true} 时在预热的临时文档中执行并报告生成的对象，不修改用户文档
+        profile: 为True时用cProfile剖析宏执行和recompute，结果中返回累计耗时最高的函数
+        profile_memory: 同时用tracemalloc统计峰值内存
+        profile_top: 返回的函数数量
+        stream: 为True时在执行期间实时接收宏的print输出和progress()，不受30秒总超时限制；
+            结果中的 stdout/stderr 为最近的输出
+        abort_pattern: 流式输出匹配该正则时中止执行（如 "Traceback|Error"）
+        idle_timeout: 流式模式下两次输出之间的最长等待秒数
     """
     try:
         # 如果传入的是相对路径或宏名称，转换为绝对路径
@@ -210,6 +795,10 @@ def run_macro(macro_path: str, params: Dict[str, Any] = None) -> Dict[str, Any]:
                 "params": params if params is not None else {}
             }
         }
+        if profile:
+            command["params"]["profile"] = {"top": profile_top, "memory": profile_memory}
+        if stream:
+            return call_freecad_streaming(command, abort_pattern, idle_timeout)
         
         # 检查是否已有运行中的事件循环，避免冲突
         try:
@@ -229,19 +818,31 @@ def run_macro(macro_path: str, params: Dict[str, Any] = None) -> Dict[str, Any]:
         return {"result": "error", "message": str(e), "traceback": traceback.format_exc()}
 
 @mcp.tool()
-def validate_macro_code(macro_name: str = None, code: str = None) -> Dict[str, Any]:
+def validate_macro_code(macro_name: str = None, code: str = None, profile: bool = False,
+                        profile_memory: bool = False, profile_top: int = 20) -> Dict[str, Any]:
     """
     验证宏代码语法
     
     Args:
         macro_name: 宏文件名称（可选）
         code: 代码内容（可选）
+        profile: 为True时用cProfile剖析验证执行
+        profile_memory: 同时用tracemalloc统计峰值内存
+        profile_top: 返回的函数数量
     """
     try:
         if macro_name:
             absolute_path = get_absolute_macro_path(macro_name)
             print(f"验证宏文件: {absolute_path}")
         
+        if code:
+            # 语法错误和未定义名称在本地即可发现
+            pre = preprocess_macro_code(code)
+            error = precheck_error(pre)
+            if error:
+                return error
+            code = pre["code"]
+        
         command = {
             "type": "validate_macro_code",
             "params": {
@@ -249,6 +850,8 @@ def validate_macro_code(macro_name: str = None, code: str = None) -> Dict[str, A
                 "code": code if code is not None else ""
             }
         }
+        if profile:
+            command["params"]["profile"] = {"top": profile_top, "memory": profile_memory}
         
         # 检查是否已有运行中的事件循环，避免冲突
         try:
@@ -267,6 +870,170 @@ def validate_macro_code(macro_name: str = None, code: str = None) -> Dict[str, A
     except Exception as e:
         return {"result": "error", "message": str(e), "traceback": traceback.format_exc()}
 
+@mcp.tool()
+def rollback_checkpoint(doc_name: str, checkpoint: str) -> Dict[str, Any]:
+    """
+    将文档撤销到 run_macro 记录的检查点，保留检查点之前已构建的几何
+    
+    Args:
+        doc_name: 文档名称
+        checkpoint: run_macro 的 params.checkpoint 中指定的检查点名称
+    """
+    try:
+        command = {"type": "rollback_checkpoint", "params": {"doc_name": doc_name, "checkpoint": checkpoint}}
+        return call_freecad(command)
+    except Exception as e:
+        return {"result": "error", "message": str(e), "traceback": traceback.format_exc()}
+
+@mcp.tool()
+def list_checkpoints(doc_name: str) -> Dict[str, Any]:
+    """
+    列出文档上记录的检查点（按时间顺序）
+    
+    Args:
+        doc_name: 文档名称
+    """
+    try:
+        return call_freecad({"type": "list_checkpoints", "params": {"doc_name": doc_name}})
+    except Exception as e:
+        return {"result": "error", "message": str(e), "traceback": traceback.format_exc()}
+
+@mcp.tool()
+def list_documents(include_memory: bool = False) -> Dict[str, Any]:
+    """
+    列出FreeCAD中已打开的文档及对象数量
+    
+    Args:
+        include_memory: 为True时估算每个文档中形状占用的内存（文档较大时较慢）
+    """
+    try:
+        return call_freecad({"type": "list_documents", "params": {"include_memory": include_memory}})
+    except Exception as e:
+        return {"result": "error", "message": str(e), "traceback": traceback.format_exc()}
+
+@mcp.tool()
+def get_mesh(doc_name: str = None, object_names: List[str] = None, deviation: float = None,
+             lod: str = "medium") -> Dict[str, Any]:
+    """
+    获取对象的细分网格，用于预览渲染
+    
+    Args:
+        doc_name: 文档名称，默认为活动文档
+        object_names: 对象名称列表，默认为文档中所有可见的形状对象
+        deviation: 细分的绝对偏差，指定时忽略 lod
+        lod: 细节级别 "high"/"medium"/"low"，偏差相对于对象包围盒对角线
+    
+    每个网格的 vertices 为小端 float32 (x, y, z) 数组，indices 为 uint32 三角形索引数组，
+    以 {"__base64__": ...} 形式返回；未变化的对象直接使用服务器缓存（cached 为 true）。
+    """
+    try:
+        params = {"doc_name": doc_name, "object_names": object_names, "deviation": deviation, "lod": lod}
+        response = call_freecad({"type": "get_mesh", "params": params})
+        return protocol.to_json_compatible(response)
+    except Exception as e:
+        return {"result": "error", "message": str(e), "traceback": traceback.format_exc()}
+
+@mcp.tool()
+def query_region(region_min: List[float], region_max: List[float], doc_name: str = None,
+                 contained: bool = False, visible_only: bool = False) -> Dict[str, Any]:
+    """
+    查询包围盒与区域相交的对象（基于服务器维护的空间索引）
+    
+    Args:
+        region_min: 区域最小角点 [x, y, z]
+        region_max: 区域最大角点 [x, y, z]
+        doc_name: 文档名称，默认为活动文档
+        contained: 为True时只返回完全位于区域内的对象
+        visible_only: 为True时忽略不可见对象
+    """
+    try:
+        params = {"doc_name": doc_name, "min": region_min, "max": region_max,
+                  "contained": contained, "visible_only": visible_only}
+        return call_freecad({"type": "query_region", "params": params})
+    except Exception as e:
+        return {"result": "error", "message": str(e), "traceback": traceback.format_exc()}
+
+@mcp.tool()
+def nearest_objects(point: List[float], k: int = 5, doc_name: str = None, max_distance: float = None,
+                    visible_only: bool = False) -> Dict[str, Any]:
+    """
+    查询包围盒离指定点最近的对象
+    
+    Args:
+        point: 查询点 [x, y, z]
+        k: 返回的对象数量
+        doc_name: 文档名称，默认为活动文档
+        max_distance: 最大距离，超出的对象不返回
+        visible_only: 为True时忽略不可见对象
+    """
+    try:
+        params = {"doc_name": doc_name, "point": point, "k": k,
+                  "max_distance": max_distance, "visible_only": visible_only}
+        return call_freecad({"type": "nearest_objects", "params": params})
+    except Exception as e:
+        return {"result": "error", "message": str(e), "traceback": traceback.format_exc()}
+
+@mcp.tool()
+def collision_candidates(doc_name: str = None, object_names: List[str] = None, tolerance: float = 0.0,
+                         visible_only: bool = True, max_pairs: int = 1000) -> Dict[str, Any]:
+    """
+    查找包围盒相交的对象对，作为碰撞检测的粗筛结果
+    
+    Args:
+        doc_name: 文档名称，默认为活动文档
+        object_names: 只检查涉及这些对象的对，默认检查全部对象
+        tolerance: 包围盒间距不超过该值即视为候选
+        visible_only: 为True时忽略不可见对象（如 Body 内部的中间特征）
+        max_pairs: 返回的最大对数
+    """
+    try:
+        params = {"doc_name": doc_name, "object_names": object_names, "tolerance": tolerance,
+                  "visible_only": visible_only, "max_pairs": max_pairs}
+        return call_freecad({"type": "collision_candidates", "params": params})
+    except Exception as e:
+        return {"result": "error", "message": str(e), "traceback": traceback.format_exc()}
+
+@mcp.tool()
+def list_requests() -> Dict[str, Any]:
+    """
+    列出本客户端在FreeCAD服务器上排队等待执行的请求
+    
+    任务或长时间运行的宏执行期间，其他命令会在服务器上排队；返回的 request_id 可用于 cancel_request。
+    queued_total 为所有客户端排队的请求总数。
+    """
+    try:
+        return call_freecad({"type": "list_requests"})
+    except Exception as e:
+        return {"result": "error", "message": str(e), "traceback": traceback.format_exc()}
+
+@mcp.tool()
+def cancel_request(request_id: str) -> Dict[str, Any]:
+    """
+    取消本客户端尚未开始执行的请求，被取消的请求返回 cancelled 错误
+    
+    Args:
+        request_id: list_requests 返回的请求ID
+    """
+    try:
+        return call_freecad({"type": "cancel_request", "params": {"request_id": request_id}})
+    except Exception as e:
+        return {"result": "error", "message": str(e), "traceback": traceback.format_exc()}
+
+@mcp.tool()
+def server_status() -> Dict[str, Any]:
+    """
+    查看FreeCAD服务器实例的健康状态、负载和各实例持有的文档
+    
+    未配置多个服务器(--servers)时只检查单个服务器是否可达。
+    """
+    try:
+        if not ROUTER:
+            return call_freecad({"type": "ping"})
+        call_freecad_async(ROUTER.check_health(force=True))
+        return {"result": "success", "servers": ROUTER.status()}
+    except Exception as e:
+        return {"result": "error", "message": str(e), "traceback": traceback.format_exc()}
+
 @mcp.tool()
 def set_view(params: Dict[str, Any]) -> Dict[str, Any]:
     """
@@ -324,23 +1091,114 @@ def get_report() -> Dict[str, Any]:
     except Exception as e:
         return {"result": "error", "message": str(e), "traceback": traceback.format_exc()}
 
+@mcp.tool()
+def submit_job(macro_path: str, params: Dict[str, Any] = None) -> Dict[str, Any]:
+    """
+    以异步任务方式运行FreeCAD宏，立即返回任务ID
+    
+    适用于超过30秒的大型装配体。宏中可调用 progress(fraction, message) 报告进度。
+    
+    Args:
+        macro_path: 宏文件路径（将自动转换为绝对路径）
+        params: 可选参数
+    """
+    try:
+        if not os.path.isabs(macro_path):
+            absolute_path = get_absolute_macro_path(os.path.basename(macro_path).replace('.FCMacro', ''))
+        else:
+            absolute_path = macro_path
+        
+        command = {
+            "type": "submit_job",
+            "params": {
+                "command": {
+                    "type": "run_macro",
+                    "params": {
+                        "macro_path": absolute_path,
+                        "params": params if params is not None else {}
+                    }
+                }
+            }
+        }
+        return call_freecad(command)
+        
+    except Exception as e:
+        return {"result": "error", "message": str(e), "traceback": traceback.format_exc()}
+
+@mcp.tool()
+def job_status(job_id: str) -> Dict[str, Any]:
+    """
+    查询异步任务的状态和进度
+    
+    Args:
+        job_id: submit_job 返回的任务ID
+    """
+    try:
+        return call_freecad({"type": "job_status", "params": {"job_id": job_id}})
+    except Exception as e:
+        return {"result": "error", "message": str(e), "traceback": traceback.format_exc()}
+
+@mcp.tool()
+def wait_job(job_id: str, timeout: float = 60) -> Dict[str, Any]:
+    """
+    等待异步任务结束，超时后返回当前状态
+    
+    Args:
+        job_id: submit_job 返回的任务ID
+        timeout: 最长等待秒数
+    """
+    try:
+        command = {"type": "wait_job", "params": {"job_id": job_id, "timeout": timeout}}
+        # 客户端超时需覆盖服务器端的等待时间
+        return call_freecad(command, timeout=timeout + 10)
+    except Exception as e:
+        return {"result": "error", "message": str(e), "traceback": traceback.format_exc()}
+
+@mcp.tool()
+def cancel_job(job_id: str) -> Dict[str, Any]:
+    """
+    取消异步任务（排队中立即取消，运行中在宏下次调用 progress() 时中止）
+    
+    Args:
+        job_id: submit_job 返回的任务ID
+    """
+    try:
+        return call_freecad({"type": "cancel_job", "params": {"job_id": job_id}})
+    except Exception as e:
+        return {"result": "error", "message": str(e), "traceback": traceback.format_exc()}
+
 def main():
     """主函数"""
     parser = argparse.ArgumentParser(description='FreeCAD MCP客户端 - 绝对路径版本')
     parser.add_argument('--host', default='localhost', help='FreeCAD服务器主机')
     parser.add_argument('--port', type=int, default=9876, help='FreeCAD服务器端口')
+    parser.add_argument('--socket', default=None, help='FreeCAD服务器Unix域套接字路径（同机部署时替代TCP）')
+    parser.add_argument('--json-only', action='store_true', help='不协商二进制帧，始终使用JSON文本协议')
+    parser.add_argument('--servers', default=None,
+                        help='多个FreeCAD服务器，逗号分隔的 host:port 或 unix:/path，设置后忽略 --host/--port/--socket')
+    parser.add_argument('--health-interval', type=float, default=5.0, help='多服务器健康检查间隔(秒)')
     
     args = parser.parse_args()
     
     # 使用小写变量名避免常量重定义警告
-    global FREECAD_HOST, FREECAD_PORT
+    global FREECAD_HOST, FREECAD_PORT, FREECAD_SOCKET, FREECAD_BINARY, ROUTER
     freecad_host = args.host
     freecad_port = args.port
     FREECAD_HOST = freecad_host
     FREECAD_PORT = freecad_port
+    FREECAD_SOCKET = args.socket
+    FREECAD_BINARY = not args.json_only
+    if args.servers:
+        targets = [parse_server_spec(spec) for spec in args.servers.split(',') if spec.strip()]
+        ROUTER = ServerRouter(targets, health_interval=args.health_interval)
     
     print(f"FreeCAD MCP客户端启动 ")
-    print(f"连接到: {FREECAD_HOST}:{FREECAD_PORT}")
+    if ROUTER:
+        print(f"连接到 {len(ROUTER.backends)} 个服务器: {', '.join(b.name for b in ROUTER.backends)}")
+    elif FREECAD_SOCKET:
+        print(f"连接到: unix:{FREECAD_SOCKET}")
+    else:
+        print(f"连接到: {FREECAD_HOST}:{FREECAD_PORT}")
 
     
     # 启动MCP服务器
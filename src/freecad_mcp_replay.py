@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+FreeCAD MCP 轨迹重放工具
+
+读取服务器记录的命令轨迹（FREECAD_MCP_TRACE），按命令到达服务器的原始节奏或加速重放，
+统计延迟分布并报告与记录响应不一致的请求:
+
+    python src/freecad_mcp_replay.py trace.fmt --speed 10 --socket /tmp/freecad_mcp.sock
+
+每个原始连接按顺序重放，在其第一条请求到期时才建立连接；同时打开的连接数
+不超过 --max-connections（应不大于服务器的 max_clients），超出时按开始时间排队。
+submit_job 返回的新任务 ID 会自动替换后续请求中的旧任务 ID。
+"""
+
+import argparse
+import json
+import os
+import socket
+import statistics
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if repo_dir not in sys.path:
+    sys.path.append(repo_dir)
+
+import freecad_mcp_protocol as protocol
+from freecad_mcp_trace import read_trace
+
+# 每次运行都会变化的字段，比较响应时忽略
+VOLATILE_KEYS = {"time", "submitted_at", "started_at", "finished_at", "job_id", "traceback",
+                 "queue_position", "progress", "progress_message", "id", "load"}
+
+
+def normalize_response(value):
+    if isinstance(value, dict):
+        return {k: normalize_response(v) for k, v in value.items() if k not in VOLATILE_KEYS}
+    if isinstance(value, list):
+        return [normalize_response(v) for v in value]
+    return value
+
+
+class ReplayConnection:
+    """一个原始连接的重放会话，hello 握手成功后切换到二进制帧"""
+
+    def __init__(self, target, timeout):
+        if target[0] == "unix":
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(target[1])
+        self.settings = None
+        self.pending = b''
+
+    def _recv(self):
+        chunk = self.sock.recv(65536)
+        if not chunk:
+            raise ConnectionError("服务器关闭了连接")
+        self.pending += chunk
+
+    def request(self, command):
+        if self.settings:
+            self.sock.sendall(protocol.encode_frame(command, self.settings["encoding"], self.settings["compress_threshold"]))
+        else:
+            self.sock.sendall(protocol.encode_json_text(command))
+        response = self._read_response()
+        if command.get("type") == "hello" and response.get("result") == "success":
+            self.settings = {
+                "encoding": response["encoding"],
+                "compress_threshold": response["compress_threshold"] if response.get("compression") else None
+            }
+        return response
+
+    def _read_response(self):
+        while True:
+            if self.settings:
+                message, consumed = protocol.decode_frame(self.pending)
+                if message is not None:
+                    self.pending = self.pending[consumed:]
+                    # 流式请求在最终响应之前的增量输出帧，与客户端一样跳过
+                    if message.get("type") == "stream" and "result" not in message:
+                        continue
+                    return message
+            elif self.pending:
+                try:
+                    message = protocol.from_json_compatible(json.loads(self.pending.decode('utf-8')))
+                    self.pending = b''
+                    return message
+                except (json.JSONDecodeError, UnicodeDecodeError):
+                    pass
+            self._recv()
+
+    def close(self):
+        self.sock.close()
+
+
+class Replayer:
+    def __init__(self, entries, target, speed, timeout, max_connections=32):
+        self.entries = entries
+        self.target = target
+        self.speed = speed
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.latencies = defaultdict(list)  # 命令类型 -> 延迟(秒)
+        self.recorded = defaultdict(list)  # 命令类型 -> 记录中从到达到响应的耗时(秒)，含排队等待
+        self.recorded_wait = defaultdict(list)  # 命令类型 -> 记录中的排队等待时间(秒)
+        self.mismatches = []
+        self.errors = []
+        self.job_ids = {}  # 记录中的任务 ID -> 重放得到的任务 ID
+        self.lock = threading.Lock()
+
+    def run(self):
+        by_conn = defaultdict(list)
+        for entry in self.entries:
+            by_conn[entry["conn"]].append(entry)
+        self.trace_start = self.entries[0]["t"]
+        self.wall_start = time.perf_counter()
+        # 按第一条请求的时间提交，线程池大小即并发连接上限
+        ordered = sorted(by_conn.values(), key=lambda conn_entries: conn_entries[0]["t"])
+        with ThreadPoolExecutor(max_workers=self.max_connections) as pool:
+            futures = [pool.submit(self._replay_connection, conn_entries) for conn_entries in ordered]
+        for future in futures:
+            future.result()
+        return time.perf_counter() - self.wall_start
+
+    def _wait_until(self, trace_time):
+        if self.speed <= 0:
+            return  # 不限速，尽快发送
+        delay = (trace_time - self.trace_start) / self.speed - (time.perf_counter() - self.wall_start)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _rewrite_job_id(self, command):
+        params = command.get("params") or {}
+        old_id = params.get("job_id")
+        if old_id is None:
+            return command
+        with self.lock:
+            new_id = self.job_ids.get(old_id, old_id)
+        return dict(command, params=dict(params, job_id=new_id))
+
+    def _replay_connection(self, entries):
+        # 到第一条请求的时间才连接，避免空闲连接占满服务器名额或触发空闲超时
+        self._wait_until(entries[0]["t"])
+        try:
+            conn = ReplayConnection(self.target, self.timeout)
+        except OSError as e:
+            with self.lock:
+                self.errors.append(f"连接失败: {e}")
+            return
+        try:
+            for entry in entries:
+                self._wait_until(entry["t"])
+                command = self._rewrite_job_id(entry["request"])
+                command_type = command.get("type")
+                start = time.perf_counter()
+                try:
+                    response = conn.request(command)
+                except (OSError, ConnectionError, protocol.ProtocolError) as e:
+                    with self.lock:
+                        self.errors.append(f"{command_type}: {e}")
+                    return
+                latency = time.perf_counter() - start
+                self._record(entry, command_type, latency, response)
+        finally:
+            conn.close()
+
+    def _record(self, entry, command_type, latency, response):
+        expected = entry["response"]
+        with self.lock:
+            self.latencies[command_type].append(latency)
+            # 旧版本轨迹没有 wait，时间戳为开始执行的时间
+            wait = entry.get("wait", 0.0)
+            self.recorded[command_type].append(wait + entry["dt"])
+            self.recorded_wait[command_type].append(wait)
+            if isinstance(expected, dict) and "job_id" in expected and "job_id" in response:
+                self.job_ids[expected["job_id"]] = response["job_id"]
+            # 延迟响应（wait_job）的记录中没有响应内容，不做比较
+            if expected is not None and normalize_response(expected) != normalize_response(response):
+                self.mismatches.append({"type": command_type, "t": entry["t"],
+                                        "expected": expected, "actual": response})
+
+
+def _percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * fraction))
+    return sorted_values[index]
+
+
+def report(replayer, elapsed, show_mismatches):
+    total = sum(len(v) for v in replayer.latencies.values())
+    print(f"重放 {total} 条请求，用时 {elapsed:.2f}s")
+    print(f"{'命令':<22}{'次数':>6}{'p50(ms)':>10}{'p90(ms)':>10}{'p99(ms)':>10}{'max(ms)':>10}"
+          f"{'记录p50(ms)':>14}{'记录等待p50(ms)':>16}")
+    all_latencies = []
+    for command_type, values in sorted(replayer.latencies.items()):
+        values = sorted(values)
+        all_latencies.extend(values)
+        recorded = statistics.median(replayer.recorded[command_type]) * 1000
+        recorded_wait = statistics.median(replayer.recorded_wait[command_type]) * 1000
+        print(f"{command_type:<22}{len(values):>6}{_percentile(values, 0.5) * 1000:>10.2f}"
+              f"{_percentile(values, 0.9) * 1000:>10.2f}{_percentile(values, 0.99) * 1000:>10.2f}"
+              f"{values[-1] * 1000:>10.2f}{recorded:>14.2f}{recorded_wait:>16.2f}")
+    if all_latencies:
+        all_latencies.sort()
+        print(f"{'全部':<22}{len(all_latencies):>6}{_percentile(all_latencies, 0.5) * 1000:>10.2f}"
+              f"{_percentile(all_latencies, 0.9) * 1000:>10.2f}{_percentile(all_latencies, 0.99) * 1000:>10.2f}"
+              f"{all_latencies[-1] * 1000:>10.2f}")
+    print(f"响应不一致: {len(replayer.mismatches)}")
+    for mismatch in replayer.mismatches[:show_mismatches]:
+        print(f"  [{mismatch['type']}] 记录: {json.dumps(protocol.to_json_compatible(mismatch['expected']), ensure_ascii=False)[:200]}")
+        print(f"  {' ' * (len(mismatch['type']) + 2)} 重放: {json.dumps(protocol.to_json_compatible(mismatch['actual']), ensure_ascii=False)[:200]}")
+    for error in replayer.errors:
+        print(f"错误: {error}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='FreeCAD MCP 轨迹重放')
+    parser.add_argument('trace', help='服务器记录的轨迹文件 (FREECAD_MCP_TRACE)')
+    parser.add_argument('--host', default='localhost', help='FreeCAD服务器主机')
+    parser.add_argument('--port', type=int, default=9876, help='FreeCAD服务器端口')
+    parser.add_argument('--socket', default=None, help='FreeCAD服务器Unix域套接字路径')
+    parser.add_argument('--speed', type=float, default=1.0, help='重放倍速，1 为原始节奏，0 为不限速')
+    parser.add_argument('--timeout', type=float, default=300, help='单个请求的超时秒数')
+    parser.add_argument('--max-connections', type=int, default=32,
+                        help='同时打开的最大连接数，应不大于服务器的 max_clients')
+    parser.add_argument('--show-mismatches', type=int, default=5, help='显示的不一致示例数量')
+    args = parser.parse_args()
+
+    entries = sorted(read_trace(args.trace), key=lambda e: e["t"])
+    if not entries:
+        print("轨迹为空")
+        return
+    target = ("unix", args.socket) if args.socket else ("tcp", (args.host, args.port))
+    replayer = Replayer(entries, target, args.speed, args.timeout, args.max_connections)
+    elapsed = replayer.run()
+    report(replayer, elapsed, args.show_mismatches)
+    sys.exit(1 if replayer.mismatches or replayer.errors else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+"""纯 Python 模块的测试；这些模块位于仓库根目录，不依赖 FreeCAD"""
+
+import os
+import sys
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if repo_dir not in sys.path:
+    sys.path.insert(0, repo_dir)
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import difflib
+
+import pytest
+
+from freecad_mcp_patch import apply_line_edits, apply_unified_diff
+
+LINES = ["import Part", "box = Part.makeBox(1, 1, 1)", "Part.show(box)"]
+
+
+def _diff(old, new, n=1):
+    return "\n".join(difflib.unified_diff(old, new, "a", "b", n=n, lineterm=""))
+
+
+def test_edit_inserts_before_first_line():
+    result = apply_line_edits(LINES, [{"start": 1, "end": 0, "text": "# header\nimport math"}])
+    assert result == ["# header", "import math"] + LINES
+
+
+def test_edit_appends_at_end_of_file():
+    result = apply_line_edits(LINES, [{"start": 4, "end": 3, "text": "print('done')"}])
+    assert result == LINES + ["print('done')"]
+
+
+def test_edits_are_relative_to_original_lines():
+    edits = [
+        {"start": 3, "end": 3, "text": "Part.show(box)\nPart.show(box2)"},
+        {"start": 2, "end": 2, "text": "box = Part.makeBox(2, 2, 2)\nbox2 = box.copy()"},
+    ]
+    result = apply_line_edits(LINES, edits)
+    assert result == ["import Part", "box = Part.makeBox(2, 2, 2)", "box2 = box.copy()",
+                      "Part.show(box)", "Part.show(box2)"]
+
+
+def test_edit_deletes_lines_with_empty_text():
+    assert apply_line_edits(LINES, [{"start": 2, "end": 3}]) == ["import Part"]
+
+
+@pytest.mark.parametrize("edits", [
+    [{"start": 1, "end": 2, "text": "a"}, {"start": 2, "end": 3, "text": "b"}],  # 重叠
+    [{"start": 2, "end": 4, "text": "a"}],  # 超出文件末尾
+    [{"start": 3, "end": 1, "text": "a"}],  # end < start - 1
+])
+def test_invalid_or_overlapping_edits_are_rejected(edits):
+    with pytest.raises(ValueError):
+        apply_line_edits(LINES, edits)
+
+
+def test_diff_inserts_at_line_zero():
+    new = ["# header"] + LINES
+    assert apply_unified_diff(LINES, _diff(LINES, new, n=0)) == new
+
+
+def test_diff_appends_at_end_of_file():
+    new = LINES + ["print('done')"]
+    assert apply_unified_diff(LINES, _diff(LINES, new, n=0)) == new
+    assert apply_unified_diff(LINES, _diff(LINES, new)) == new
+
+
+def test_diff_with_several_hunks():
+    old = [f"line {i}" for i in range(20)]
+    new = list(old)
+    new[2] = "changed 2"
+    new[15:17] = ["changed 15"]
+    assert apply_unified_diff(old, _diff(old, new)) == new
+
+
+def test_diff_to_empty_file():
+    assert apply_unified_diff([], _diff([], LINES)) == LINES
+
+
+def test_overlapping_hunks_are_rejected():
+    diff = "@@ -1,2 +1,2 @@\n import Part\n-box = Part.makeBox(1, 1, 1)\n+box = None\n" \
+           "@@ -2,1 +2,1 @@\n-box = Part.makeBox(1, 1, 1)\n+box = 1\n"
+    with pytest.raises(ValueError):
+        apply_unified_diff(LINES, diff)
+
+
+def test_context_mismatch_is_rejected():
+    diff = "@@ -2,2 +2,2 @@\n box = Part.makeBox(9, 9, 9)\n-Part.show(box)\n+Part.show(box, 'x')\n"
+    with pytest.raises(ValueError, match="上下文不匹配"):
+        apply_unified_diff(LINES, diff)
+
+
+def test_hunk_past_end_of_file_is_rejected():
+    diff = "@@ -3,2 +3,2 @@\n Part.show(box)\n-missing\n+added\n"
+    with pytest.raises(ValueError):
+        apply_unified_diff(LINES, diff)
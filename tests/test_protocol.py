@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import json
+import zlib
+
+import pytest
+
+import freecad_mcp_protocol as protocol
+
+
+def _frame(body, attachments=(), flags=0, payload=None, lengths=None):
+    """手工拼装一帧，用于构造异常输入"""
+    body = json.dumps(body).encode('utf-8')
+    raw = b"".join([body, *attachments])
+    if payload is None:
+        payload = zlib.compress(raw) if flags & protocol.FLAG_COMPRESSED else raw
+    if lengths is None:
+        lengths = [len(body)] + [len(a) for a in attachments]
+    header = protocol.HEADER.pack(protocol.MAGIC, flags, protocol.ENCODING_JSON, len(lengths) - 1, len(payload))
+    return header + b"".join(protocol.LENGTH.pack(n) for n in lengths) + payload
+
+
+def test_round_trip_with_attachments_and_compression():
+    message = {"type": "get_mesh", "meshes": [{"vertices": b"\x00" * 10000, "indices": b"\x01\x02"}]}
+    frame = protocol.encode_frame(message, "json", compress_threshold=1024)
+    decoded, consumed = protocol.decode_frame(frame + b"FM")
+    assert decoded == message
+    assert consumed == len(frame)
+
+
+@pytest.mark.parametrize("cut", [1, protocol.HEADER.size - 1, protocol.HEADER.size + 2, -1])
+def test_truncated_frame_waits_for_more_data(cut):
+    frame = protocol.encode_frame({"type": "ping", "data": b"abc"})
+    assert protocol.decode_frame(frame[:cut]) == (None, 0)
+
+
+def test_bad_magic_is_rejected():
+    frame = protocol.encode_frame({"type": "ping"})
+    with pytest.raises(protocol.ProtocolError):
+        protocol.decode_frame(b"XX" + frame[2:])
+
+
+def test_decompression_is_bounded_by_declared_length():
+    # 小帧声明 10 字节，实际解压后为 1 MB
+    bomb = zlib.compress(b"{}" + b" " * (1024 * 1024))
+    frame = _frame({}, flags=protocol.FLAG_COMPRESSED, payload=bomb, lengths=[10])
+    with pytest.raises(protocol.ProtocolError):
+        protocol.decode_frame(frame)
+
+
+def test_declared_length_over_limit_is_rejected():
+    frame = _frame({}, payload=b"{}", lengths=[protocol.MAX_MESSAGE_SIZE + 1])
+    with pytest.raises(protocol.ProtocolError):
+        protocol.decode_frame(frame)
+
+
+def test_corrupt_compressed_payload_is_a_protocol_error():
+    frame = _frame({}, flags=protocol.FLAG_COMPRESSED, payload=b"not zlib", lengths=[2])
+    with pytest.raises(protocol.ProtocolError):
+        protocol.decode_frame(frame)
+
+
+def test_length_table_must_match_payload():
+    frame = _frame({"a": 1}, lengths=[3])
+    with pytest.raises(protocol.ProtocolError):
+        protocol.decode_frame(frame)
+
+
+@pytest.mark.parametrize("index", [1, -1, "0", None, True])
+def test_bad_attachment_index_is_rejected(index):
+    frame = _frame({"data": {protocol.ATTACHMENT_KEY: index}}, attachments=[b"xyz"])
+    with pytest.raises(protocol.ProtocolError):
+        protocol.decode_frame(frame)
+
+
+def test_json_text_restores_base64_bytes():
+    text = protocol.encode_json_text({"data": b"\x00\xff"})
+    assert protocol.from_json_compatible(json.loads(text)) == {"data": b"\x00\xff"}
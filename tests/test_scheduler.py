@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from freecad_mcp_scheduler import CommandScheduler, SchedulerFull, TimerWheel
+
+
+def _submit(scheduler, client, request_id, **command):
+    # 与真实客户端一样，每条命令使用一个新连接
+    connection = object()
+    scheduler.submit(client, dict(command, type="run_macro", id=request_id), connection)
+    return connection
+
+
+def _drain(scheduler):
+    order = []
+    while True:
+        entry = scheduler.next()
+        if entry is None:
+            return order
+        client, _, request_id, _, _ = entry
+        scheduler.complete(client)
+        order.append(request_id)
+
+
+def test_flooding_client_interleaves_with_other_client():
+    scheduler = CommandScheduler()
+    for i in range(6):
+        _submit(scheduler, "agent-a", f"a{i}")
+    _submit(scheduler, "agent-b", "b0")
+    _submit(scheduler, "agent-b", "b1")
+    assert _drain(scheduler) == ["a0", "b0", "a1", "b1", "a2", "a3", "a4", "a5"]
+
+
+def test_inflight_limit_applies_across_connections():
+    scheduler = CommandScheduler(max_inflight_per_client=3)
+    for i in range(3):
+        _submit(scheduler, "agent-a", f"a{i}")
+    with pytest.raises(SchedulerFull):
+        _submit(scheduler, "agent-a", "a3")
+    _submit(scheduler, "agent-b", "b0")
+    client = scheduler.next()[0]
+    scheduler.complete(client)
+    _submit(scheduler, "agent-a", "a3")
+
+
+def test_response_goes_to_submitting_connection():
+    scheduler = CommandScheduler()
+    first = _submit(scheduler, "agent-a", "a0")
+    second = _submit(scheduler, "agent-a", "a1")
+    assert scheduler.next()[1] is first
+    assert scheduler.next()[1] is second
+
+
+def test_cancel_only_within_own_queue():
+    scheduler = CommandScheduler()
+    connection = _submit(scheduler, "agent-a", "a0")
+    assert scheduler.cancel("agent-b", "a0") is None
+    cancelled_connection, command = scheduler.cancel("agent-a", "a0")
+    assert cancelled_connection is connection and command["id"] == "a0"
+    assert scheduler.inflight == {}
+    assert scheduler.next() is None
+
+
+def test_cancelled_client_is_not_scheduled_twice():
+    scheduler = CommandScheduler()
+    _submit(scheduler, "agent-a", "a0")
+    scheduler.cancel("agent-a", "a0")
+    _submit(scheduler, "agent-a", "a1")
+    _submit(scheduler, "agent-a", "a2")
+    _submit(scheduler, "agent-b", "b0")
+    assert _drain(scheduler) == ["a1", "b0", "a2"]
+
+
+def test_closed_connection_drops_only_its_commands():
+    scheduler = CommandScheduler()
+    _submit(scheduler, "agent-a", "a0")
+    closed = _submit(scheduler, "agent-a", "a1")
+    scheduler.remove_connection(closed)
+    assert scheduler.inflight == {"agent-a": 1}
+    assert [entry[0] for entry in scheduler.queued("agent-a")] == ["a0"]
+    assert _drain(scheduler) == ["a0"]
+
+
+def test_arrival_time_is_kept_with_queued_command():
+    scheduler = CommandScheduler()
+    scheduler.submit("agent-a", {"type": "run_macro", "id": "a0"}, object(), received_at=12.5)
+    assert scheduler.queued("agent-a")[0][3] == 12.5
+    assert scheduler.next()[4] == 12.5
+
+
+def test_priority_policy_prefers_highest_priority_head():
+    scheduler = CommandScheduler(policy="priority")
+    _submit(scheduler, "agent-a", "a0")
+    _submit(scheduler, "agent-b", "b0", priority=5)
+    assert _drain(scheduler) == ["b0", "a0"]
+
+
+def test_timer_wheel_expires_only_due_keys():
+    wheel = TimerWheel(tick=0.5, now=0.0)
+    wheel.schedule("idle", 1.0)
+    wheel.schedule("busy", 1.0)
+    wheel.touch("busy", 5.0)
+    assert wheel.advance(2.0) == ["idle"]
+    assert wheel.advance(4.0) == []
+    assert wheel.advance(5.5) == ["busy"]
+    assert len(wheel) == 0